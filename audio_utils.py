@@ -1,11 +1,35 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
+import inspect
+import json
 import librosa
 import librosa.filters
 import numpy as np
+import scipy.sparse
 from scipy import signal
 from params import hparams
 
+try:
+    # keeps single precision, numpy.fft always computes in double
+    from scipy.fft import rfft as _rfft
+except ImportError:
+    from numpy.fft import rfft as _rfft
+
+
+# bump when the extracted features change numerically, e.g. version 2 is melspectrogram_batch
+MEL_EXTRACTOR_VERSION = 2
+
+
+def feature_fingerprint():
+    '''hash of the extractor version and of the hparams which determine the extracted features'''
+    keys = ['num_mels', 'n_fft', 'sample_rate', 'win_length', 'hop_length',
+            'preemphasis', 'min_level_db', 'ref_level_db']
+    values = {k: getattr(hparams, k) for k in keys}
+    values['extractor_version'] = MEL_EXTRACTOR_VERSION
+    values = json.dumps(values, sort_keys=True)
+    return hashlib.md5(values.encode('utf-8')).hexdigest()
+
 
 def preemphasis(x):
     return signal.lfilter([1, -hparams.preemphasis], [1], x)
@@ -57,3 +81,70 @@ def _build_mel_basis():
 
 def _normalize(S):
     return np.clip((S - hparams.min_level_db) / -hparams.min_level_db, 0, 1)
+
+
+# keyed on (sample_rate, n_fft, num_mels)
+_sparse_mel_bases = {}
+
+
+def _sparse_mel_basis():
+    key = (hparams.sample_rate, hparams.n_fft, hparams.num_mels)
+    if key not in _sparse_mel_bases:
+        # every fft bin falls into at most two triangular filters, so the basis is very sparse
+        _sparse_mel_bases[key] = scipy.sparse.csr_matrix(_build_mel_basis().astype(np.float32))
+    return _sparse_mel_bases[key]
+
+
+def _stft_window():
+    n_fft, hop_length, win_length = _stft_parameters()
+    window = signal.get_window('hann', win_length, fftbins=True).astype(np.float32)
+    lpad = (n_fft - win_length) // 2
+    return np.pad(window, [lpad, n_fft - win_length - lpad], mode='constant')
+
+
+def _stft_pad_mode():
+    # librosa changed the default padding of centered frames from reflect to constant
+    pad_mode = inspect.signature(librosa.stft).parameters.get('pad_mode')
+    if pad_mode is None or pad_mode.default is inspect.Parameter.empty:
+        return 'reflect'
+    return pad_mode.default
+
+
+def melspectrogram_batch(ys):
+    '''
+    float32 melspectrogram of several signals at once, matches melspectrogram within float32 tolerance
+    :param ys: list of 1-D signals
+    :return: list of T_i*num_mels mel spectrums
+    '''
+    n_fft, hop_length, win_length = _stft_parameters()
+    pad_mode = _stft_pad_mode()
+
+    padded = []
+    n_frames = []
+    for y in ys:
+        y = np.asarray(y, dtype=np.float32)
+        # preemphasis, same as lfilter([1, -preemphasis], [1], y)
+        emphasized = np.empty_like(y)
+        emphasized[:1] = y[:1]
+        emphasized[1:] = y[1:] - hparams.preemphasis * y[:-1]
+        # centered frames
+        padded.append(np.pad(emphasized, n_fft // 2, mode=pad_mode))
+        n_frames.append(1 + len(y) // hop_length)
+
+    max_frames = max(n_frames)
+    batch = np.zeros([len(ys), n_fft + (max_frames - 1) * hop_length], dtype=np.float32)
+    for i, y in enumerate(padded):
+        length = min(len(y), batch.shape[1])
+        batch[i, :length] = y[:length]
+
+    # B*F*n_fft strided view of the frames, without copying
+    frames = np.lib.stride_tricks.as_strided(
+        batch, shape=[len(ys), max_frames, n_fft],
+        strides=[batch.strides[0], hop_length * batch.strides[1], batch.strides[1]], writeable=False)
+    magnitudes = np.abs(_rfft(frames * _stft_window(), axis=-1)).astype(np.float32)
+
+    mel = _sparse_mel_basis().dot(magnitudes.reshape(-1, magnitudes.shape[-1]).T).T
+    mel = mel.reshape(len(ys), max_frames, -1)
+    S = (20 * np.log10(np.maximum(np.float32(1e-5), mel)) - hparams.ref_level_db).astype(np.float32)
+    mel_specs = _normalize(S)
+    return [mel_spec[:frames_i] for mel_spec, frames_i in zip(mel_specs, n_frames)]
@@ -0,0 +1,590 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+import numpy as np
+from params import hparams
+
+# hparams values benchmarked by default, every combination of them is one configuration
+GRAPH_MATRIX = ';'.join([
+    'lc_encode=true|false',
+    'transposed_upsampling=false|true',
+    'n_layers=8|4',
+    'residual_channels=256|128',
+    'n_group=8|16',
+])
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='WaveGlow benchmarks')
+    parser.add_argument('--cpu', action='store_true',
+                        help='hide gpus from tensorflow')
+    parser.add_argument('--iterations', type=int, default=10,
+                        help='timed runs of each variant')
+    parser.add_argument('--warmup', type=int, default=2,
+                        help='untimed runs before timing')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    lc_projection = subparsers.add_parser('lc_projection',
+                                          help='per layer vs batched local condition projections of one WaveNet')
+    lc_projection.add_argument('--frames', type=int, default=100, help='lc frames')
+    lc_projection.add_argument('--batch_size', type=int, default=1)
+    lc_projection.add_argument('--rtol', type=float, default=1e-3)
+    lc_projection.add_argument('--atol', type=float, default=1e-4)
+
+    variants = subparsers.add_parser('variants',
+                                     help='forward network under different values of one hparam')
+    variants.add_argument('--hparam', type=str, required=True, help='name of the hparam to vary')
+    variants.add_argument('--values', type=str, required=True, help='comma separated values of the hparam')
+    variants.add_argument('--frames', type=int, default=100, help='lc frames')
+    variants.add_argument('--batch_size', type=int, default=1)
+    variants.add_argument('--gradients', action='store_true',
+                          help='also compare and time the gradients of the loss')
+    variants.add_argument('--rtol', type=float, default=1e-3,
+                          help='relative tolerance of the parity check against the first value')
+    variants.add_argument('--atol', type=float, default=1e-5,
+                          help='absolute tolerance of the parity check against the first value')
+
+    conv = subparsers.add_parser('causal_conv', help='check and time every dilated_conv_backend of causal_conv '
+                                                     'against time_to_batch on the same weights and input')
+    conv.add_argument('--length', type=int, default=4000, help='squeezed audio length')
+    conv.add_argument('--batch_size', type=int, default=1)
+    conv.add_argument('--rtol', type=float, default=1e-3)
+    conv.add_argument('--atol', type=float, default=1e-4)
+
+    lstm = subparsers.add_parser('lstm_checkpoint', help='restore a checkpoint of the LSTMCell lc encoder into '
+                                                         'the fused lstm encoder and check the outputs')
+    lstm.add_argument('--frames', type=int, default=200, help='lc frames')
+    lstm.add_argument('--batch_size', type=int, default=4, help='utterances, each shorter than the previous one')
+    lstm.add_argument('--rtol', type=float, default=1e-4)
+    lstm.add_argument('--atol', type=float, default=1e-5)
+
+    mel = subparsers.add_parser('mel', help='melspectrogram vs batched melspectrogram_batch extraction')
+    mel.add_argument('--seconds', type=float, default=5., help='length of every synthetic signal')
+    mel.add_argument('--batch_size', type=int, default=16, help='signals extracted by one call')
+    # normalized mels are in [0, 1], 1e-3 is about 0.1dB
+    mel.add_argument('--rtol', type=float, default=0.)
+    mel.add_argument('--atol', type=float, default=1e-3)
+
+    imports = subparsers.add_parser('imports', help='import time and memory of modules, each in a fresh process')
+    # train is imported as __mp_main__ by every spawned data process of --input_pipeline=process
+    imports.add_argument('--modules', type=str,
+                         default='params,audio_utils,data_reader,preprocess_data,train,tensorflow',
+                         help='comma separated modules')
+
+    graph = subparsers.add_parser('graph', help='training and inference speed and memory across a matrix of '
+                                                'hparams configurations, every run in a fresh process')
+    graph.add_argument('--matrix', type=str, default=GRAPH_MATRIX,
+                       help='semicolon separated hparams, each with | separated values, '
+                            'every combination of the values is benchmarked')
+    graph.add_argument('--configs', type=str, default=None,
+                       help='semicolon separated configurations instead of --matrix, each a comma separated '
+                            'list of hparams overrides, default is params.py as is')
+    graph.add_argument('--frames', type=str, default='100,400', help='comma separated lc frames')
+    graph.add_argument('--batch_sizes', type=str, default='1,4', help='comma separated batch sizes')
+    graph.add_argument('--output', type=str, default='benchmark.json', help='where to save the results')
+    graph.add_argument('--baseline', type=str, default=None,
+                       help='results of a previous run to compare with, regressions make the exit status 1')
+    graph.add_argument('--threshold', type=float, default=0.1,
+                       help='relative slowdown or memory growth reported as regression')
+
+    graph_run = subparsers.add_parser('graph_run', help='one run of the graph benchmark, prints a json line')
+    graph_run.add_argument('--hparams', type=str, default='', help='comma separated hparams overrides')
+    graph_run.add_argument('--frames', type=int, default=100)
+    graph_run.add_argument('--batch_size', type=int, default=1)
+    return parser.parse_args()
+
+
+def parse_hparam_value(name, value):
+    current = getattr(hparams, name)
+    if isinstance(current, bool):
+        if value.lower() not in ['true', 'false']:
+            raise ValueError('{} needs a boolean, got {}'.format(name, value))
+        return value.lower() == 'true'
+    return type(current)(value)
+
+
+def synthetic_batch(batch_size, frames):
+    '''random audio B*(T*hop)*1 and lc B*T*80 in the layout fed to the forward network'''
+    audio = np.random.uniform(-0.5, 0.5, [batch_size, frames * hparams.upsampling_rate, 1]).astype(np.float32)
+    lc = np.random.rand(batch_size, frames, hparams.num_mels).astype(np.float32)
+    return audio, lc
+
+
+def create_session(args):
+    import tensorflow as tf
+    config = tf.ConfigProto(log_device_placement=False, allow_soft_placement=True)
+    if args.cpu:
+        config.device_count['GPU'] = 0
+    return tf.Session(config=config)
+
+
+def check_parity(reference, results, rtol, atol):
+    '''
+    compare named arrays with np.allclose, a name missing on either side is a mismatch
+    :return: max abs difference of the common arrays and the mismatched names
+    '''
+    mismatches = sorted(set(reference) ^ set(results))
+    max_diff = 0.
+    for name in sorted(set(reference) & set(results)):
+        a, b = np.asarray(reference[name]), np.asarray(results[name])
+        if a.shape != b.shape:
+            mismatches.append(name)
+            continue
+        max_diff = max(max_diff, float(np.max(np.abs(a - b))))
+        if not np.allclose(b, a, rtol=rtol, atol=atol):
+            mismatches.append(name)
+    return max_diff, mismatches
+
+
+def randomize_variables(sess, seed=1234):
+    '''fill every trainable variable with random values, zero initialized layers would hide differences'''
+    import tensorflow as tf
+    rng = np.random.RandomState(seed)
+    for var in tf.trainable_variables():
+        shape = var.get_shape().as_list()
+        var.load(rng.randn(*shape).astype(np.float32) * 0.1, sess)
+
+
+def time_run(sess, fetches, feed_dict, warmup, iterations):
+    '''mean seconds of one sess.run'''
+    for _ in range(warmup):
+        sess.run(fetches, feed_dict=feed_dict)
+    start_time = time.time()
+    for _ in range(iterations):
+        sess.run(fetches, feed_dict=feed_dict)
+    return (time.time() - start_time) / iterations
+
+
+def peak_memory(sess, fetches, feed_dict):
+    '''peak bytes of every allocator during one traced sess.run'''
+    import tensorflow as tf
+    run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+    run_metadata = tf.RunMetadata()
+    sess.run(fetches, feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)
+    peaks = {}
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            for memory in node_stats.memory:
+                peaks[memory.allocator_name] = max(peaks.get(memory.allocator_name, 0), memory.peak_bytes)
+    return peaks
+
+
+def bench_lc_projection(args):
+    import tensorflow as tf
+    from glow import WaveNet, WaveGlow
+
+    glow = WaveGlow(lc_dim=hparams.num_mels, n_flows=hparams.n_flows, n_group=hparams.n_group,
+                    n_early_every=hparams.n_early_every, n_early_size=hparams.n_early_size)
+    n_lc_dim = glow.lc_dim * glow.n_group
+    n_half = glow.n_group // 2
+    length = args.frames * hparams.upsampling_rate // hparams.n_group
+
+    audio = tf.placeholder(tf.float32, [None, None, n_half])
+    lc = tf.placeholder(tf.float32, [None, None, n_lc_dim])
+    outputs = {}
+    batch_lc_projection = hparams.batch_lc_projection
+    with tf.variable_scope('wavenet_benchmark', reuse=tf.AUTO_REUSE):
+        for mode in [False, True]:
+            hparams.set_hparam('batch_lc_projection', mode)
+            wavenet = WaveNet(n_half, n_lc_dim, hparams.n_layers, hparams.residual_channels, hparams.skip_channels)
+            outputs[mode] = wavenet.create_network(audio, lc)
+    hparams.set_hparam('batch_lc_projection', batch_lc_projection)
+
+    sess = create_session(args)
+    sess.run(tf.global_variables_initializer())
+    randomize_variables(sess)
+
+    feed_dict = {audio: np.random.randn(args.batch_size, length, n_half).astype(np.float32),
+                 lc: np.random.rand(args.batch_size, length, n_lc_dim).astype(np.float32)}
+    per_layer, batched = sess.run([outputs[False], outputs[True]], feed_dict=feed_dict)
+    max_diff, mismatches = check_parity(dict(zip(['log_s', 'shift'], per_layer)),
+                                        dict(zip(['log_s', 'shift'], batched)), args.rtol, args.atol)
+
+    # both variants do the same multiply-adds, the batched one reads lc_batch once by one wide matmul
+    flops = 2 * args.batch_size * length * n_lc_dim * 2 * hparams.residual_channels * hparams.n_layers
+    print('lc projection of {:d} layers, {:d} x {:d} -> {:d} channels, {:.2f} GFLOPs per WaveNet'
+          .format(hparams.n_layers, length, n_lc_dim, 2 * hparams.residual_channels, flops / 1e9))
+    print('max abs difference between per layer and batched: {:.3e}'.format(max_diff))
+    if mismatches:
+        print('MISMATCH beyond rtol={} atol={}: {}'.format(args.rtol, args.atol, ', '.join(mismatches)))
+        sys.exit(1)
+    for mode, label in [(False, 'per layer'), (True, 'batched')]:
+        duration = time_run(sess, outputs[mode], feed_dict, args.warmup, args.iterations)
+        print('{:>10s}: {:d} matmuls, {:.4f}s per WaveNet'
+              .format(label, 1 if mode else hparams.n_layers, duration))
+
+
+def bench_variants(args):
+    '''
+    build the forward network once per value of the hparam, sharing variables, time them and check that
+    z, loss and gradients of every value match the first one, exits with status 1 otherwise
+    '''
+    import tensorflow as tf
+    from glow import WaveGlow, compute_waveglow_loss
+
+    values = [parse_hparam_value(args.hparam, v) for v in args.values.split(',')]
+    default_value = getattr(hparams, args.hparam)
+
+    audio = tf.placeholder(tf.float32, [None, None, 1])
+    lc = tf.placeholder(tf.float32, [None, None, hparams.num_mels])
+    fetches = []
+    fetch_names = []
+    # resource variables, so that recompute_flow_activations could share them with other variants
+    with tf.variable_scope(tf.get_variable_scope(), reuse=tf.AUTO_REUSE, use_resource=True):
+        for value in values:
+            hparams.set_hparam(args.hparam, value)
+            with tf.name_scope('{}_{}'.format(args.hparam, value)):
+                glow = WaveGlow(lc_dim=hparams.num_mels, n_flows=hparams.n_flows, n_group=hparams.n_group,
+                                n_early_every=hparams.n_early_every, n_early_size=hparams.n_early_size)
+                z, log_s_list, log_det_W_list = glow.create_forward_network(audio, lc)
+                loss = compute_waveglow_loss(z, log_s_list, log_det_W_list, sigma=hparams.sigma)
+                outputs = [z, loss]
+                names = ['z', 'loss']
+                if args.gradients:
+                    variables = tf.trainable_variables()
+                    for var, grad in zip(variables, tf.gradients(loss, variables)):
+                        if grad is not None:
+                            outputs.append(grad)
+                            names.append(var.op.name)
+                fetches.append(outputs)
+                fetch_names.append(names)
+    hparams.set_hparam(args.hparam, default_value)
+
+    sess = create_session(args)
+    sess.run(tf.global_variables_initializer())
+    randomize_variables(sess)
+
+    audio_value, lc_value = synthetic_batch(args.batch_size, args.frames)
+    feed_dict = {audio: audio_value, lc: lc_value}
+    results = sess.run(fetches, feed_dict=feed_dict)
+
+    reference = dict(zip(fetch_names[0], results[0]))
+    failed = False
+    for value, outputs, names, result in zip(values, fetches, fetch_names, results):
+        max_diff, mismatches = check_parity(reference, dict(zip(names, result)), args.rtol, args.atol)
+        duration = time_run(sess, outputs, feed_dict, args.warmup, args.iterations)
+        peaks = peak_memory(sess, outputs, feed_dict)
+        print('{}={}: loss={:.6f}, max abs difference to {}={}: {:.3e}, {:.4f}s per run, '
+              '{:.1f} samples/sec, peak memory {}'
+              .format(args.hparam, value, result[1], args.hparam, values[0], max_diff, duration,
+                      args.batch_size * args.frames * hparams.upsampling_rate / duration,
+                      ', '.join('{} {:.1f}MB'.format(k, v / 1024. / 1024.) for k, v in sorted(peaks.items()))))
+        if mismatches:
+            failed = True
+            print('    MISMATCH of {} arrays beyond rtol={} atol={}: {}'
+                  .format(len(mismatches), args.rtol, args.atol, ', '.join(mismatches[:5])))
+
+    if failed:
+        sys.exit(1)
+    print('all values match {}={}'.format(args.hparam, values[0]))
+
+
+def bench_causal_conv(args):
+    '''
+    outputs and gradients of causal_conv for the dilations of a WaveNet, every backend is checked against
+    time_to_batch, nchw only where a gpu is present, exits with status 1 on a mismatch
+    '''
+    import tensorflow as tf
+    from glow import causal_conv
+
+    backends = ['time_to_batch', 'atrous']
+    if not args.cpu and tf.test.is_gpu_available():
+        backends.append('nchw')
+    else:
+        print('no gpu, nchw backend skipped')
+
+    rng = np.random.RandomState(1234)
+    channels = hparams.residual_channels
+    value = tf.placeholder(tf.float32, [None, None, channels])
+    fetches = {backend: {} for backend in backends}
+    for i in range(hparams.n_layers):
+        dilation = 2 ** i
+        filter_ = tf.constant(rng.randn(hparams.kernel_size, channels, 2 * channels).astype(np.float32) * 0.1)
+        for backend in backends:
+            if backend == 'nchw':
+                output = causal_conv(tf.transpose(value, [0, 2, 1]), filter_, dilation, hparams.kernel_size,
+                                     backend=backend)
+                output = tf.transpose(output, [0, 2, 1])
+            else:
+                output = causal_conv(value, filter_, dilation, hparams.kernel_size, backend=backend)
+            grad_value, grad_filter = tf.gradients(output, [value, filter_])
+            fetches[backend]['dilation_%d' % dilation] = output
+            fetches[backend]['dilation_%d/grad_value' % dilation] = grad_value
+            fetches[backend]['dilation_%d/grad_filter' % dilation] = grad_filter
+
+    sess = create_session(args)
+    feed_dict = {value: rng.randn(args.batch_size, args.length, channels).astype(np.float32)}
+    results = {backend: sess.run(fetches[backend], feed_dict=feed_dict) for backend in backends}
+
+    failed = False
+    for backend in backends:
+        max_diff, mismatches = check_parity(results['time_to_batch'], results[backend], args.rtol, args.atol)
+        duration = time_run(sess, fetches[backend], feed_dict, args.warmup, args.iterations)
+        print('{:>14s}: max abs difference to time_to_batch {:.3e}, {:.4f}s per {:d} layers forward and backward'
+              .format(backend, max_diff, duration, hparams.n_layers))
+        if mismatches:
+            failed = True
+            print('    MISMATCH beyond rtol={} atol={}: {}'.format(args.rtol, args.atol, ', '.join(mismatches)))
+    if failed:
+        sys.exit(1)
+
+
+def bench_lstm_checkpoint(args):
+    '''
+    write a checkpoint of the lc encoder built with LSTMCell, restore it into the encoder built with
+    LSTMBlockFusedCell, check that variable names and outputs within the sequence lengths match and time both,
+    exits with status 1 otherwise
+    '''
+    import tempfile
+    import tensorflow as tf
+    from glow import WaveGlow
+
+    rng = np.random.RandomState(1234)
+    lc_value = rng.rand(args.batch_size, args.frames, hparams.num_mels).astype(np.float32)
+    lengths_value = np.array([max(args.frames - 7 * i, 1) for i in range(args.batch_size)], dtype=np.int32)
+
+    fused_lstm = hparams.lc_encode_fused_lstm
+    checkpoint_dir = tempfile.mkdtemp()
+    checkpoint_path = None
+    results, names = {}, {}
+    try:
+        for fused in [False, True]:
+            hparams.set_hparam('lc_encode_fused_lstm', fused)
+            with tf.Graph().as_default():
+                lc = tf.placeholder(tf.float32, [None, None, hparams.num_mels])
+                lengths = tf.placeholder(tf.int32, [None])
+                glow = WaveGlow(lc_dim=hparams.num_mels, n_flows=hparams.n_flows, n_group=hparams.n_group,
+                                n_early_every=hparams.n_early_every, n_early_size=hparams.n_early_size)
+                with tf.variable_scope('Waveglow'):
+                    encoded = glow.create_lc_blstm_network(lc, sequence_length=lengths)
+                names[fused] = sorted(var.op.name for var in tf.trainable_variables())
+                saver = tf.train.Saver(var_list=tf.trainable_variables())
+
+                with create_session(args) as sess:
+                    if fused:
+                        try:
+                            saver.restore(sess, checkpoint_path)
+                        except tf.errors.NotFoundError as e:
+                            print('MISMATCH: the LSTMCell checkpoint does not restore into the fused encoder\n{}'
+                                  .format(e.message))
+                            sys.exit(1)
+                    else:
+                        sess.run(tf.global_variables_initializer())
+                        randomize_variables(sess)
+                        checkpoint_path = saver.save(sess, os.path.join(checkpoint_dir, 'model.ckpt'))
+
+                    feed_dict = {lc: lc_value, lengths: lengths_value}
+                    results[fused] = sess.run(encoded, feed_dict=feed_dict)
+                    duration = time_run(sess, encoded, feed_dict, args.warmup, args.iterations)
+                    print('{:>8s}: {:.4f}s per encoding of {:d} x {:d} frames'
+                          .format('fused' if fused else 'LSTMCell', duration, args.batch_size, args.frames))
+    finally:
+        hparams.set_hparam('lc_encode_fused_lstm', fused_lstm)
+        shutil.rmtree(checkpoint_dir)
+
+    if names[False] != names[True]:
+        print('MISMATCH of variable names: {}'.format(sorted(set(names[False]) ^ set(names[True]))))
+        sys.exit(1)
+    # both encoders output zeros beyond the sequence lengths
+    max_diff, mismatches = check_parity({'encoder': results[False]}, {'encoder': results[True]}, args.rtol, args.atol)
+    print('max abs difference between LSTMCell and fused encoder outputs: {:.3e}'.format(max_diff))
+    if mismatches:
+        print('MISMATCH beyond rtol={} atol={}'.format(args.rtol, args.atol))
+        sys.exit(1)
+
+
+def bench_mel(args):
+    from audio_utils import melspectrogram, melspectrogram_batch
+
+    rng = np.random.RandomState(1234)
+    # vary lengths a little, so that padding and trimming are exercised
+    ys = [rng.uniform(-0.5, 0.5, int(args.seconds * hparams.sample_rate) + rng.randint(0, hparams.hop_length * 4))
+          for _ in range(args.batch_size)]
+    audio_seconds = sum(len(y) for y in ys) / float(hparams.sample_rate)
+
+    references = {'signal_{}'.format(i): mel for i, mel in enumerate(melspectrogram(y) for y in ys)}
+    batched = {'signal_{}'.format(i): mel for i, mel in enumerate(melspectrogram_batch(ys))}
+    max_diff, mismatches = check_parity(references, batched, args.rtol, args.atol)
+    print('max abs difference between melspectrogram and melspectrogram_batch: {:.3e}'.format(max_diff))
+    if mismatches:
+        print('MISMATCH beyond rtol={} atol={}: {}'.format(args.rtol, args.atol, ', '.join(mismatches)))
+        sys.exit(1)
+
+    for label, extract in [('per signal', lambda: [melspectrogram(y) for y in ys]),
+                           ('batched', lambda: melspectrogram_batch(ys))]:
+        for _ in range(args.warmup):
+            extract()
+        start_time = time.time()
+        for _ in range(args.iterations):
+            extract()
+        duration = (time.time() - start_time) / args.iterations
+        print('{:>10s}: {:.4f}s per {:d} signals, {:.1f}x real time'
+              .format(label, duration, len(ys), audio_seconds / duration))
+
+
+IMPORT_PROBE = '''
+import resource, sys, time
+start_time = time.time()
+import {module}
+print(time.time() - start_time, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, 'tensorflow' in sys.modules)
+'''
+
+
+def bench_imports(args):
+    for module in args.modules.split(','):
+        try:
+            output = subprocess.check_output([sys.executable, '-c', IMPORT_PROBE.format(module=module)])
+        except subprocess.CalledProcessError:
+            print('{:>16s}: import failed'.format(module))
+            continue
+        seconds, max_rss, tf_loaded = output.decode('utf-8').split()[-3:]
+        # ru_maxrss is in kilobytes on linux
+        print('{:>16s}: {:.3f}s, peak rss {:.1f}MB, tensorflow loaded: {}'
+              .format(module, float(seconds), int(max_rss) / 1024., tf_loaded))
+
+
+def bench_graph_run(args):
+    '''
+    training steps (forward, gradients and adam update) and inference of one configuration,
+    variables keep their initial values, which is enough for timing
+    '''
+    import resource
+    import tensorflow as tf
+    from glow import WaveGlow, compute_waveglow_loss
+
+    hparams.parse(args.hparams)
+    audio_value, lc_value = synthetic_batch(args.batch_size, args.frames)
+    audio_seconds = args.batch_size * args.frames * hparams.upsampling_rate / float(hparams.sample_rate)
+
+    def create_glow():
+        return WaveGlow(lc_dim=hparams.num_mels, n_flows=hparams.n_flows, n_group=hparams.n_group,
+                        n_early_every=hparams.n_early_every, n_early_size=hparams.n_early_size)
+
+    with tf.Graph().as_default():
+        audio = tf.placeholder(tf.float32, [None, None, 1])
+        lc = tf.placeholder(tf.float32, [None, None, hparams.num_mels])
+        z, log_s_list, log_det_W_list = create_glow().create_forward_network(audio, lc)
+        loss = compute_waveglow_loss(z, log_s_list, log_det_W_list, sigma=hparams.sigma)
+        train_ops = tf.train.AdamOptimizer(learning_rate=hparams.lr).minimize(loss)
+        with create_session(args) as sess:
+            sess.run(tf.global_variables_initializer())
+            train_duration = time_run(sess, train_ops, {audio: audio_value, lc: lc_value},
+                                      args.warmup, args.iterations)
+
+    with tf.Graph().as_default():
+        lc = tf.placeholder(tf.float32, [None, None, hparams.num_mels])
+        audio = create_glow().infer(lc, sigma=0.6)
+        with create_session(args) as sess:
+            sess.run(tf.global_variables_initializer())
+            infer_duration = time_run(sess, audio, {lc: lc_value}, args.warmup, args.iterations)
+
+    result = {'train_audio_samples_per_sec': args.batch_size * args.frames * hparams.upsampling_rate / train_duration,
+              'infer_rtf': infer_duration / audio_seconds,
+              # ru_maxrss is in kilobytes on linux
+              'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.}
+    print(json.dumps(result))
+
+
+def compare_with_baseline(results, baseline, threshold):
+    ''':return: descriptions of the results worse than the baseline by more than threshold'''
+    def key(result):
+        return result['config'], result['frames'], result['batch_size']
+
+    baseline = {key(result): result for result in baseline if 'error' not in result}
+    regressions = []
+    for result in results:
+        base = baseline.get(key(result))
+        if base is None or 'error' in result or 'train_audio_samples_per_sec' not in base:
+            continue
+        # higher is better for throughput, lower is better for rtf and memory
+        changes = [('train_audio_samples_per_sec',
+                    base['train_audio_samples_per_sec'] / result['train_audio_samples_per_sec'] - 1),
+                   ('infer_rtf', result['infer_rtf'] / base['infer_rtf'] - 1),
+                   ('peak_rss_mb', result['peak_rss_mb'] / base['peak_rss_mb'] - 1)]
+        for name, change in changes:
+            if change > threshold:
+                regressions.append('{} frames={} batch_size={}: {} {:.3f} -> {:.3f}'
+                                   .format(result['config'], result['frames'], result['batch_size'],
+                                           name, base[name], result[name]))
+    return regressions
+
+
+def matrix_configs(matrix):
+    '''"a=1|2;b=x|y" -> ["a=1,b=x", "a=1,b=y", "a=2,b=x", "a=2,b=y"]'''
+    axes = []
+    for axis in matrix.split(';'):
+        name, values = axis.split('=', 1)
+        axes.append(['{}={}'.format(name.strip(), value.strip()) for value in values.split('|')])
+    return [','.join(combination) for combination in itertools.product(*axes)]
+
+
+def bench_graph(args):
+    configs = args.configs.split(';') if args.configs is not None else matrix_configs(args.matrix)
+    results = []
+    for config in configs:
+        overrides = '' if config == 'default' else config
+        for frames in [int(x) for x in args.frames.split(',')]:
+            for batch_size in [int(x) for x in args.batch_sizes.split(',')]:
+                command = [sys.executable, os.path.abspath(__file__), '--iterations', str(args.iterations),
+                           '--warmup', str(args.warmup)]
+                if args.cpu:
+                    command.append('--cpu')
+                command += ['graph_run', '--hparams', overrides, '--frames', str(frames),
+                            '--batch_size', str(batch_size)]
+
+                result = {'config': config, 'frames': frames, 'batch_size': batch_size}
+                try:
+                    output = subprocess.check_output(command)
+                    result.update(json.loads(output.decode('utf-8').strip().split('\n')[-1]))
+                    print('{} frames={:d} batch_size={:d}: {:.0f} train audio samples/sec, rtf={:.3f}, '
+                          'peak rss {:.1f}MB'.format(config, frames, batch_size, result['train_audio_samples_per_sec'],
+                                                     result['infer_rtf'], result['peak_rss_mb']))
+                except subprocess.CalledProcessError:
+                    result['error'] = 'failed'
+                    print('{} frames={:d} batch_size={:d}: failed'.format(config, frames, batch_size))
+                results.append(result)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('results saved to {}'.format(args.output))
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            regressions = compare_with_baseline(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print('REGRESSION {}'.format(regression))
+        if regressions:
+            sys.exit(1)
+        print('no regression against {}'.format(args.baseline))
+
+
+def main():
+    args = get_arguments()
+    if args.benchmark == 'lc_projection':
+        bench_lc_projection(args)
+    elif args.benchmark == 'variants':
+        bench_variants(args)
+    elif args.benchmark == 'causal_conv':
+        bench_causal_conv(args)
+    elif args.benchmark == 'lstm_checkpoint':
+        bench_lstm_checkpoint(args)
+    elif args.benchmark == 'mel':
+        bench_mel(args)
+    elif args.benchmark == 'imports':
+        bench_imports(args)
+    elif args.benchmark == 'graph':
+        bench_graph(args)
+    elif args.benchmark == 'graph_run':
+        bench_graph_run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,19 @@
 import os
+import sys
+import json
 import random
 import threading
+import time
+import traceback
 import codecs
+import collections
 import queue
+import multiprocessing as mp
+from multiprocessing import shared_memory
 import librosa
 import numpy as np
 from params import hparams
+from audio_utils import melspectrogram_batch, feature_fingerprint
 
 
 def read_binary_lc(file_path, dimension):
@@ -18,27 +26,222 @@ def read_binary_lc(file_path, dimension):
     return features
 
 
-def read_wave_and_lc_features(filelist_scpfile, wave_dir, lc_dir):
+def read_filelist(filelist_scpfile):
     filelist = []
     with codecs.open(filelist_scpfile, 'r', 'utf-8') as f:
         for line in f:
             line = line.strip()
             file_id = line
             filelist.append(file_id)
+    return filelist
+
+
+def read_wave_and_lc(file_id, wave_dir, lc_dir):
+    wave_path = os.path.join(wave_dir, file_id + '.wav')
+    lc_path = os.path.join(lc_dir, file_id + '.mel')
+
+    # read wave
+    audio, _ = librosa.load(wave_path, sr=hparams.sample_rate, mono=True)
+    audio = audio.reshape(-1, 1)
+
+    # read local condition
+    lc_features = read_binary_lc(lc_path, hparams.num_mels)
+    return audio, lc_features
+
+
+def read_wave_and_lc_features(filelist_scpfile, wave_dir, lc_dir):
+    filelist = read_filelist(filelist_scpfile)
 
     random.shuffle(filelist)
     for file_id in filelist:
-        wave_path = os.path.join(wave_dir, file_id + '.wav')
-        lc_path = os.path.join(lc_dir, file_id + '.mel')
+        audio, lc_features = read_wave_and_lc(file_id, wave_dir, lc_dir)
+        yield audio, lc_features, file_id
 
-        # read wave
-        audio, _ = librosa.load(wave_path, sr=hparams.sample_rate, mono=True)
-        audio = audio.reshape(-1, 1)
 
-        # read local condition
-        lc_features = read_binary_lc(lc_path, hparams.num_mels)
+class LRUFeatureCache(object):
+    '''
+    Size bounded LRU cache of lc features computed on the fly, kept in memory and optionally in a
+    size bounded directory shared by worker processes. Cached files are named after the feature
+    fingerprint, so features of other hparams are never returned.
+    '''
+
+    def __init__(self, max_mb=1024, cache_dir=None, max_dir_mb=10240):
+        self.max_bytes = max_mb * 1024 * 1024
+        self.cache_dir = cache_dir
+        self.max_dir_bytes = max_dir_mb * 1024 * 1024
+        self.suffix = '.{}.mel'.format(feature_fingerprint()[:8])
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+
+        # file name -> size, in least recently used order
+        self.dir_entries = collections.OrderedDict()
+        self.dir_bytes = 0
+        if cache_dir is not None:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            files = [e for e in os.scandir(cache_dir) if e.is_file() and e.name.endswith('.mel')]
+            for e in sorted(files, key=lambda e: e.stat().st_mtime):
+                self.dir_entries[e.name] = e.stat().st_size
+                self.dir_bytes += e.stat().st_size
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        if self.cache_dir is None:
+            return None
+        name = key + self.suffix
+        path = os.path.join(self.cache_dir, name)
+        try:
+            value = read_binary_lc(path, hparams.num_mels)
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        with self.lock:
+            if name in self.dir_entries:
+                self.dir_entries.move_to_end(name)
+        self.put(key, value, write_dir=False)
+        return value
+
+    def put(self, key, value, write_dir=True):
+        with self.lock:
+            if key not in self.entries and value.nbytes <= self.max_bytes:
+                self.entries[key] = value
+                self.bytes += value.nbytes
+                while self.bytes > self.max_bytes:
+                    _, evicted = self.entries.popitem(last=False)
+                    self.bytes -= evicted.nbytes
+
+        if self.cache_dir is None or not write_dir:
+            return
+        name = key + self.suffix
+        path = os.path.join(self.cache_dir, name)
+        # unique per thread, py_func threads of the tf.data pipeline may write the same key at once
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        value.astype(np.float32).tofile(tmp_path)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            self.dir_bytes += value.nbytes - self.dir_entries.pop(name, 0)
+            self.dir_entries[name] = value.nbytes
+            while self.dir_bytes > self.max_dir_bytes and len(self.dir_entries) > 1:
+                evicted, size = self.dir_entries.popitem(last=False)
+                self.dir_bytes -= size
+                try:
+                    os.remove(os.path.join(self.cache_dir, evicted))
+                except OSError:
+                    pass
+
+
+def pcm_to_float(audio):
+    '''convert int16 or float16 audio read from shards to float32 in [-1, 1]'''
+    if audio.dtype == np.int16:
+        return audio.astype(np.float32) / 32768.
+    return audio.astype(np.float32)
 
-        yield audio, lc_features, file_id
+
+class ShardReader(object):
+    '''
+    Reads packed shards written by preprocess_data.py: pre-resampled int16 or float16 audio and float16 lc,
+    force aligned, concatenated into raw shard files and located by index.json. Shards are memory-mapped,
+    so reading a file returns views and no decoding is done.
+    '''
+
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        with codecs.open(os.path.join(shard_dir, 'index.json'), 'r', 'utf-8') as f:
+            index = json.load(f)
+
+        assert index['sample_rate'] == hparams.sample_rate and index['num_mels'] == hparams.num_mels \
+            and index['hop_length'] == hparams.upsampling_rate, 'shards do not match hparams'
+        self.audio_dtype = np.dtype(index['audio_dtype'])
+        self.files = {entry['id']: entry for entry in index['files']}
+        self.lock = threading.Lock()
+        self.audio_maps = {}
+        self.lc_maps = {}
+
+    def shard_maps(self, shard):
+        with self.lock:
+            if shard not in self.audio_maps:
+                prefix = os.path.join(self.shard_dir, 'shard_%05d' % shard)
+                self.audio_maps[shard] = np.memmap(prefix + '.audio', dtype=self.audio_dtype, mode='r')
+                self.lc_maps[shard] = np.memmap(prefix + '.lc', dtype=np.float16, mode='r')
+            return self.audio_maps[shard], self.lc_maps[shard]
+
+    def read(self, file_id):
+        '''
+        :return: views of aligned audio T*1 and lc frames F*80 of file_id, T == F * hop_length
+        '''
+        entry = self.files[file_id]
+        audio_map, lc_map = self.shard_maps(entry['shard'])
+        frames = entry['frames']
+        n_samples = frames * hparams.upsampling_rate
+        audio = audio_map[entry['audio_offset']:entry['audio_offset'] + n_samples]
+        lc = lc_map[entry['lc_offset']:entry['lc_offset'] + frames * hparams.num_mels]
+        return audio.reshape(-1, 1), lc.reshape(-1, hparams.num_mels)
+
+
+def shuffle_pieces(iterator, buffer_size):
+    '''yield items of iterator in random order through a bounded shuffle buffer'''
+    if buffer_size <= 1:
+        for item in iterator:
+            yield item
+        return
+
+    buffer = []
+    for item in iterator:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        i = random.randrange(buffer_size)
+        yield buffer[i]
+        buffer[i] = item
+
+    random.shuffle(buffer)
+    for item in buffer:
+        yield item
+
+
+def force_align(audio, lc_features, upsample_rate):
+    '''clip audio and local condition so that len(audio) == len(lc_features) * upsample_rate'''
+    if len(audio) > len(lc_features) * upsample_rate:
+        # clip audio
+        audio = audio[:len(lc_features) * upsample_rate, :]
+    elif len(audio) < len(lc_features) * upsample_rate:
+        # clip local condition and audio
+        audio_frames = len(audio) // upsample_rate
+        frames = min(audio_frames, len(lc_features))
+        audio = audio[:frames*upsample_rate, :]
+        lc_features = lc_features[:frames, :]
+    else:
+        pass
+    return audio, lc_features
+
+
+def random_pieces(audio, lc_features, lc_frames, upsample_rate):
+    '''
+    split aligned audio and local condition into consecutive pieces of lc_frames frames,
+    starting from a random frame
+    :return: N*(lc_frames*upsample_rate)*1 audio pieces and N*lc_frames*dim lc pieces
+    '''
+    # add random-ness for the data-generator
+    frames = len(lc_features)
+    if frames > lc_frames:
+        max_frame_start = frames - lc_frames
+        lc_start = random.randint(0, max_frame_start)
+
+        audio = audio[lc_start*upsample_rate:, :]
+        lc_features = lc_features[lc_start:, :]
+
+    n_pieces = min(len(audio) // (lc_frames * upsample_rate), len(lc_features) // lc_frames)
+    audio = audio[:n_pieces * lc_frames * upsample_rate, :]
+    lc_features = lc_features[:n_pieces * lc_frames, :]
+    audio_pieces = np.reshape(audio, [n_pieces, lc_frames * upsample_rate, 1])
+    lc_pieces = np.reshape(lc_features, [n_pieces, lc_frames, lc_features.shape[-1]])
+    return audio_pieces, lc_pieces
 
 
 class DataReader(object):
@@ -50,11 +253,25 @@ class DataReader(object):
                  filelist,
                  wave_dir,
                  lc_dir,
-                 queue_size=512):
+                 queue_size=512,
+                 shard_dir=None,
+                 lc_cache_mb=1024,
+                 lc_cache_dir=None,
+                 lc_cache_dir_mb=10240):
         self.coord = coord
         self.filelist = filelist
         self.wave_dir = wave_dir
         self.lc_dir = lc_dir
+        self.shards = None
+        if shard_dir is not None:
+            self.shards = ShardReader(shard_dir)
+        # without lc_dir, lc features are computed from the waves and cached
+        self.lc_cache = None
+        if shard_dir is None and lc_dir is None:
+            self.lc_cache = LRUFeatureCache(lc_cache_mb, lc_cache_dir, lc_cache_dir_mb)
+        self.reader_kwargs = {'filelist': filelist, 'wave_dir': wave_dir, 'lc_dir': lc_dir,
+                              'queue_size': queue_size, 'shard_dir': shard_dir, 'lc_cache_mb': lc_cache_mb,
+                              'lc_cache_dir': lc_cache_dir, 'lc_cache_dir_mb': lc_cache_dir_mb}
         self.lc_dim = hparams.num_mels
         self.lc_frames = hparams.sample_size // hparams.upsampling_rate
         # recompute a sample size
@@ -62,66 +279,292 @@ class DataReader(object):
         self.upsample_rate = hparams.upsampling_rate
         self.threads = []
         self.queue = queue.Queue(maxsize=queue_size)
+        self.shuffle_buffer_size = hparams.shuffle_buffer_size
+        self.shuffle_buffer = []
+        # instrumentation of the training loop, see occupancy()
+        self.wait_time = 0.
+        self.pieces_produced = 0
+        self.pieces_consumed = 0
 
     def dequeue(self, num_elements):
-        batch_audio = np.empty([0, self.sample_size, 1])
-        batch_lc = np.empty([0, self.lc_frames, self.lc_dim])
+        batch_audio = np.empty([num_elements, self.sample_size, 1], dtype=np.float32)
+        batch_lc = np.empty([num_elements, self.lc_frames, self.lc_dim], dtype=np.float32)
         for i in range(num_elements):
-            audio, lc = self.queue.get(block=True)
-            audio = np.reshape(audio, [1, self.sample_size, 1])
-            lc = np.reshape(lc, [1, self.lc_frames, self.lc_dim])
-            batch_audio = np.concatenate([batch_audio, audio], axis=0)
-            batch_lc = np.concatenate([batch_lc, lc], axis=0)
+            audio, lc = self.next_piece()
+            batch_audio[i] = np.reshape(audio, [self.sample_size, 1])
+            batch_lc[i] = np.reshape(lc, [self.lc_frames, self.lc_dim])
+        self.pieces_consumed += num_elements
 
         return batch_audio, batch_lc
 
-    def thread_main(self):
+    def next_piece(self):
+        '''take a random piece from the shuffle buffer, refilled from the queue'''
+        while len(self.shuffle_buffer) < max(self.shuffle_buffer_size, 1):
+            start_time = time.time()
+            self.shuffle_buffer.append(self.queue.get(block=True))
+            self.wait_time += time.time() - start_time
+        i = random.randrange(len(self.shuffle_buffer))
+        self.shuffle_buffer[i], self.shuffle_buffer[-1] = self.shuffle_buffer[-1], self.shuffle_buffer[i]
+        return self.shuffle_buffer.pop()
+
+    def occupancy(self):
+        '''pieces read but not consumed yet, by the tf.data pipeline pieces_consumed is counted by the caller'''
+        return self.pieces_produced - self.pieces_consumed
+
+    def worker_filelist(self, worker_index=0, n_workers=1):
+        '''files of one worker, files are partitioned so that every file is decoded once per epoch'''
+        return read_filelist(self.filelist)[worker_index::n_workers]
+
+    def read_wave_and_computed_lc(self, file_id):
+        audio, _ = librosa.load(os.path.join(self.wave_dir, file_id + '.wav'), sr=hparams.sample_rate, mono=True)
+        lc_features = self.lc_cache.get(file_id)
+        if lc_features is None:
+            lc_features = melspectrogram_batch([audio])[0]
+            self.lc_cache.put(file_id, lc_features)
+        return audio.reshape(-1, 1), lc_features
+
+    def load_aligned(self, file_id):
+        '''read one file and force align it, audio of shards is still int16 or float16'''
+        if self.shards is not None:
+            # already aligned, only the pieces are copied out of the memory-mapped shards
+            return self.shards.read(file_id)
+        if self.lc_cache is not None:
+            audio, lc_features = self.read_wave_and_computed_lc(file_id)
+        else:
+            audio, lc_features = read_wave_and_lc(file_id, self.wave_dir, self.lc_dir)
+        return force_align(audio, lc_features, self.upsample_rate)
+
+    def load_pieces(self, file_id):
+        '''read one file, force align it and split it into random pieces'''
+        audio, lc_features = self.load_aligned(file_id)
+        audio_pieces, lc_pieces = random_pieces(audio, lc_features, self.lc_frames, self.upsample_rate)
+        self.pieces_produced += len(audio_pieces)
+        return pcm_to_float(audio_pieces), lc_pieces.astype(np.float32)
+
+    def create_dataset(self, batch_size, num_parallel_calls=4, prefetch_batches=2, device=None):
+        '''
+        tf.data pipeline replacing the python threads and queue, files are decoded by parallel map,
+        their pieces are batched into fixed shapes and prefetched, optionally to device
+        :return: dataset of (B*sample_size*1 audio, B*lc_frames*dim lc)
+        '''
+        # imported here, so that data loading processes do not load tensorflow
+        import tensorflow as tf
+
+        filelist = read_filelist(self.filelist)
+
+        def _load_pieces(file_id):
+            return self.load_pieces(file_id.decode('utf-8'))
+
+        def _map(file_id):
+            audio, lc = tf.py_func(_load_pieces, [file_id], [tf.float32, tf.float32], stateful=True)
+            audio.set_shape([None, self.sample_size, 1])
+            lc.set_shape([None, self.lc_frames, self.lc_dim])
+            return audio, lc
+
+        dataset = tf.data.Dataset.from_tensor_slices(filelist)
+        # go through the dataset multiple times
+        dataset = dataset.shuffle(len(filelist), reshuffle_each_iteration=True).repeat()
+        dataset = dataset.map(_map, num_parallel_calls=num_parallel_calls)
+        dataset = dataset.flat_map(lambda audio, lc: tf.data.Dataset.from_tensor_slices((audio, lc)))
+        if self.shuffle_buffer_size > 1:
+            dataset = dataset.shuffle(self.shuffle_buffer_size)
+        dataset = dataset.batch(batch_size, drop_remainder=True)
+        dataset = dataset.prefetch(prefetch_batches)
+        if device is not None:
+            dataset = dataset.apply(tf.contrib.data.prefetch_to_device(device))
+        return dataset
+
+    def thread_main(self, worker_index=0, n_workers=1):
         stop = False
+        filelist = self.worker_filelist(worker_index, n_workers)
         # Go through the dataset multiple times
         while not stop:
-            iterator = read_wave_and_lc_features(self.filelist,
-                                                 self.wave_dir,
-                                                 self.lc_dir)
-            for audio, lc_features, file_id in iterator:
+            random.shuffle(filelist)
+            for file_id in filelist:
                 if self.coord.should_stop():
                     stop = True
                     break
 
-                # force align wave & local condition
-                if len(audio) > len(lc_features) * self.upsample_rate:
-                    # clip audio
-                    audio = audio[:len(lc_features) * self.upsample_rate, :]
-                elif len(audio) < len(lc_features) * self.upsample_rate:
-                    # clip local condition and audio
-                    audio_frames = len(audio) // self.upsample_rate
-                    frames = min(audio_frames, len(lc_features))
-                    audio = audio[:frames*self.upsample_rate, :]
-                    lc_features = lc_features[:frames, :]
-                else:
-                    pass
-
-                # add random-ness for the data-generator
-                frames = len(lc_features)
-                if frames > self.lc_frames:
-                    max_frame_start = frames - self.lc_frames
-                    lc_start = random.randint(0, max_frame_start)
-
-                    audio = audio[lc_start*self.upsample_rate:, :]
-                    lc_features = lc_features[lc_start:, :]
-
-                while len(audio) >= self.sample_size and len(lc_features) >= self.lc_frames:
-                    audio_piece = audio[:self.sample_size, :]
-                    lc_piece = lc_features[:self.lc_frames, :]
+                audio_pieces, lc_pieces = self.load_pieces(file_id)
+                for audio_piece, lc_piece in zip(audio_pieces, lc_pieces):
                     self.queue.put([audio_piece, lc_piece])
 
-                    audio = audio[self.sample_size:, :]
-                    lc_features = lc_features[self.lc_frames:, :]
-
     def start_threads(self, n_threads=1):
-        for _ in range(n_threads):
-            thread = threading.Thread(target=self.thread_main, args=())
+        for i in range(n_threads):
+            thread = threading.Thread(target=self.thread_main, args=(i, n_threads))
             thread.daemon = True  # Thread will close when parent quits.
             thread.start()
             self.threads.append(thread)
 
         return self.threads
+
+
+def _process_worker_main(reader_kwargs, worker_index, n_workers, batch_size, audio_shm_name, lc_shm_name, n_slots,
+                         free_slots, full_slots, stop_event, errors, seed):
+    try:
+        _process_worker_loop(reader_kwargs, worker_index, n_workers, batch_size, audio_shm_name, lc_shm_name,
+                             n_slots, free_slots, full_slots, stop_event, seed)
+    except Exception:
+        # sent back to the trainer, which raises it from dequeue
+        errors.put((worker_index, traceback.format_exc()))
+        raise
+
+
+def _process_worker_loop(reader_kwargs, worker_index, n_workers, batch_size, audio_shm_name, lc_shm_name, n_slots,
+                         free_slots, full_slots, stop_event, seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    reader = DataReader(None, **reader_kwargs)
+    # tensorflow should not be loaded by the spawned process
+    try:
+        import resource
+        # ru_maxrss is in kilobytes on linux
+        peak_rss = '{:.1f}MB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.)
+    except ImportError:
+        # not available on windows
+        peak_rss = 'unknown'
+    print('data process {:d} started, peak rss {}, tensorflow loaded: {}'
+          .format(worker_index, peak_rss, 'tensorflow' in sys.modules))
+
+    audio_shm = shared_memory.SharedMemory(name=audio_shm_name)
+    lc_shm = shared_memory.SharedMemory(name=lc_shm_name)
+    audio_ring = np.ndarray([n_slots, batch_size, reader.sample_size, 1], dtype=np.float32, buffer=audio_shm.buf)
+    lc_ring = np.ndarray([n_slots, batch_size, reader.lc_frames, reader.lc_dim], dtype=np.float32, buffer=lc_shm.buf)
+
+    def pieces():
+        filelist = reader.worker_filelist(worker_index, n_workers)
+        # Go through the dataset multiple times
+        while True:
+            random.shuffle(filelist)
+            for file_id in filelist:
+                audio_pieces, lc_pieces = reader.load_pieces(file_id)
+                for audio_piece, lc_piece in zip(audio_pieces, lc_pieces):
+                    yield audio_piece, lc_piece
+
+    try:
+        iterator = shuffle_pieces(pieces(), reader.shuffle_buffer_size)
+        while not stop_event.is_set():
+            try:
+                slot = free_slots.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            for i in range(batch_size):
+                audio_ring[slot, i], lc_ring[slot, i] = next(iterator)
+            full_slots.put(slot)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        del audio_ring, lc_ring
+        audio_shm.close()
+        lc_shm.close()
+
+
+class ProcessDataReader(DataReader):
+    '''
+    Reads data by worker processes instead of threads, so that decoding is not serialized by the GIL.
+    Workers write whole batches into a ring of slots in shared memory, dequeue returns views of a slot
+    without copying, the slot is handed back to the workers on the next dequeue.
+    '''
+
+    def __init__(self,
+                 coord,
+                 filelist,
+                 wave_dir,
+                 lc_dir,
+                 batch_size,
+                 n_slots=8,
+                 **kwargs):
+        super(ProcessDataReader, self).__init__(coord, filelist, wave_dir, lc_dir, **kwargs)
+        self.batch_size = batch_size
+        self.n_slots = n_slots
+        self.processes = []
+
+        audio_shape = [n_slots, batch_size, self.sample_size, 1]
+        lc_shape = [n_slots, batch_size, self.lc_frames, self.lc_dim]
+        self.audio_shm = shared_memory.SharedMemory(create=True, size=int(np.prod(audio_shape)) * 4)
+        self.lc_shm = shared_memory.SharedMemory(create=True, size=int(np.prod(lc_shape)) * 4)
+        self.audio_ring = np.ndarray(audio_shape, dtype=np.float32, buffer=self.audio_shm.buf)
+        self.lc_ring = np.ndarray(lc_shape, dtype=np.float32, buffer=self.lc_shm.buf)
+
+        ctx = mp.get_context('spawn')
+        self.free_slots = ctx.Queue()
+        self.full_slots = ctx.Queue()
+        self.errors = ctx.Queue()
+        self.stop_event = ctx.Event()
+        for slot in range(n_slots):
+            self.free_slots.put(slot)
+        self.current_slot = None
+
+    def dequeue(self, num_elements):
+        assert num_elements == self.batch_size, 'batch size is fixed by the shared memory ring'
+        if self.current_slot is not None:
+            # the previous batch has been consumed by the training step
+            self.free_slots.put(self.current_slot)
+        start_time = time.time()
+        self.current_slot = None
+        while self.current_slot is None:
+            try:
+                self.current_slot = self.full_slots.get(timeout=1.0)
+            except queue.Empty:
+                # a dead worker never fills its slots, fail instead of waiting forever
+                self.check_processes()
+        self.wait_time += time.time() - start_time
+        return self.audio_ring[self.current_slot], self.lc_ring[self.current_slot]
+
+    def check_processes(self):
+        '''raise the error of a worker process which exited before the reader was stopped'''
+        if self.stop_event.is_set():
+            return
+        for i, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            try:
+                worker_index, error = self.errors.get(timeout=1.0)
+            except queue.Empty:
+                # killed without a python exception, e.g. by the oom killer
+                worker_index, error = i, 'no traceback'
+            raise RuntimeError('data process {:d} exited with code {}:\n{}'
+                               .format(worker_index, self.processes[worker_index].exitcode, error))
+
+    def occupancy(self):
+        '''pieces of the batches ready in the shared memory ring'''
+        return self.full_slots.qsize() * self.batch_size
+
+    def start_processes(self, n_processes=1):
+        ctx = mp.get_context('spawn')
+        for i in range(n_processes):
+            process = ctx.Process(target=_process_worker_main,
+                                  args=(self.reader_kwargs, i, n_processes, self.batch_size, self.audio_shm.name, self.lc_shm.name,
+                                        self.n_slots, self.free_slots, self.full_slots, self.stop_event,
+                                        self.errors, random.randint(0, 2 ** 31 - 1)))
+            process.daemon = True  # Process will close when parent quits.
+            process.start()
+            self.processes.append(process)
+
+        # stop the workers and release shared memory when the coordinator stops
+        thread = threading.Thread(target=self.shutdown_main, args=())
+        thread.daemon = True
+        thread.start()
+        self.coord.register_thread(thread)
+        self.threads.append(thread)
+        return self.processes
+
+    def shutdown_main(self):
+        self.coord.wait_for_stop()
+        self.stop_event.set()
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self.free_slots.cancel_join_thread()
+        self.full_slots.cancel_join_thread()
+        self.audio_shm.unlink()
+        self.lc_shm.unlink()
+        del self.audio_ring, self.lc_ring
+        try:
+            self.audio_shm.close()
+            self.lc_shm.close()
+        except BufferError:
+            # the last dequeued batch is still referenced by the trainer, released on exit
+            pass
@@ -0,0 +1,109 @@
+#! -*- encoding: utf-8 -*-
+from __future__ import print_function
+import argparse
+import os
+import time
+import numpy as np
+import tensorflow as tf
+from data_reader import DataReader, read_filelist, pcm_to_float
+from glow import WaveGlow, compute_waveglow_loss
+from params import hparams
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Evaluate WaveGlow checkpoints on the test set')
+    parser.add_argument('--logdir', type=str, required=True,
+                        help='log directory of the training run, watched for new checkpoints')
+    parser.add_argument('--filelist', type=str, required=True,
+                        help='test filelist, e.g. test.scp written by preprocess_data.py')
+    parser.add_argument('--wave_dir', type=str, default=None, help='wave data directory')
+    parser.add_argument('--lc_dir', type=str, default=None, help='local condition directory')
+    parser.add_argument('--shard_dir', type=str, default=None,
+                        help='packed shards written by preprocess_data.py, instead of --wave_dir and --lc_dir')
+    parser.add_argument('--crop_frames', type=int, default=hparams.sample_size // hparams.upsampling_rate,
+                        help='lc frames of the crop taken from the start of every file')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--timeout', type=int, default=None,
+                        help='seconds to wait for a new checkpoint before exiting, default waits forever')
+    parser.add_argument('--nice', type=int, default=10,
+                        help='niceness added to this process, so that it yields cpu to training, ignored on windows')
+    parser.add_argument('--gpu', action='store_true',
+                        help='evaluate on gpu, by default only cpu is used to leave the gpus to training')
+    return parser.parse_args()
+
+
+def load_eval_crops(reader, file_ids, crop_frames):
+    '''
+    fixed crops of crop_frames frames from the start of every file, so that every checkpoint is evaluated
+    on the same data, files shorter than a crop are skipped
+    '''
+    rate = hparams.upsampling_rate
+    audio_crops, lc_crops = [], []
+    for file_id in file_ids:
+        audio, lc = reader.load_aligned(file_id)
+        if len(lc) < crop_frames:
+            continue
+        audio_crops.append(pcm_to_float(audio[:crop_frames * rate]).reshape(-1, 1))
+        lc_crops.append(np.asarray(lc[:crop_frames], dtype=np.float32))
+    assert len(audio_crops) > 0, 'no test file is longer than {} frames'.format(crop_frames)
+    return np.stack(audio_crops), np.stack(lc_crops)
+
+
+def evaluate(sess, fetches, audio_placeholder, lc_placeholder, audio_crops, lc_crops, batch_size):
+    '''mean of the fetched losses over all crops'''
+    total = 0.
+    for start in range(0, len(audio_crops), batch_size):
+        feed_dict = {audio_placeholder: audio_crops[start:start + batch_size],
+                     lc_placeholder: lc_crops[start:start + batch_size]}
+        # losses are means over the batch, weight them by its size
+        total += sess.run(fetches, feed_dict=feed_dict) * len(feed_dict[audio_placeholder])
+    return total / len(audio_crops)
+
+
+def main():
+    args = get_arguments()
+    assert args.shard_dir is not None or args.wave_dir is not None, \
+        'either --shard_dir or --wave_dir should be specified'
+    # os.nice is not available on windows
+    if args.nice > 0 and hasattr(os, 'nice'):
+        os.nice(args.nice)
+
+    reader = DataReader(None, args.filelist, args.wave_dir, args.lc_dir, shard_dir=args.shard_dir)
+    audio_crops, lc_crops = load_eval_crops(reader, read_filelist(args.filelist), args.crop_frames)
+    print('evaluate on {} crops of {} frames'.format(len(audio_crops), args.crop_frames))
+
+    audio_placeholder = tf.placeholder(tf.float32, shape=[None, None, 1], name='audio')
+    lc_placeholder = tf.placeholder(tf.float32, shape=[None, None, hparams.num_mels], name='lc')
+    glow = WaveGlow(lc_dim=hparams.num_mels,
+                    n_flows=hparams.n_flows,
+                    n_group=hparams.n_group,
+                    n_early_every=hparams.n_early_every,
+                    n_early_size=hparams.n_early_size)
+    output_audio, log_s_list, log_det_W_list = glow.create_forward_network(audio_placeholder, lc_placeholder)
+    loss = compute_waveglow_loss(output_audio, log_s_list, log_det_W_list, sigma=hparams.sigma)
+
+    config = tf.ConfigProto(log_device_placement=False, allow_soft_placement=True)
+    if not args.gpu:
+        config.device_count['GPU'] = 0
+    sess = tf.Session(config=config)
+    saver = tf.train.Saver(var_list=tf.trainable_variables())
+    writer = tf.summary.FileWriter(os.path.join(args.logdir, 'eval'))
+
+    for checkpoint_path in tf.train.checkpoints_iterator(args.logdir, timeout=args.timeout):
+        step = int(checkpoint_path.split('-')[-1])
+        try:
+            saver.restore(sess, checkpoint_path)
+        except tf.errors.NotFoundError:
+            # removed by max_to_keep before it was evaluated
+            print('{} not found, skipped'.format(checkpoint_path))
+            continue
+
+        start_time = time.time()
+        nll = evaluate(sess, loss, audio_placeholder, lc_placeholder, audio_crops, lc_crops, args.batch_size)
+        writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag='eval/nll', simple_value=nll)]), step)
+        writer.flush()
+        print('step {:d} - eval nll = {:.4f}, time cost={:.1f}s'.format(step, nll, time.time() - start_time))
+
+
+if __name__ == '__main__':
+    main()
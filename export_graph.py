@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+from inference import create_inference_graph
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Export a frozen WaveGlow inference graph')
+    parser.add_argument('--restore_from', type=str, default=None, required=True,
+                        help='restore model from checkpoint')
+    parser.add_argument('--output', type=str, default='waveglow.pb',
+                        help='path of the frozen GraphDef')
+    parser.add_argument('--sigma', type=float, default=0.6,
+                        help='sigma value for inference, fixed in the exported graph')
+    return parser.parse_args()
+
+
+def export_graph(restore_from, output, sigma):
+    '''
+    restore the inference graph from checkpoint, convert variables to constants and fold every
+    constant subgraph, e.g. weight norm g * l2_normalize(w) and the inverse of 1x1 conv weights,
+    so that they are not recomputed by every run
+    '''
+    with tf.Graph().as_default():
+        lc_placeholder, lc_lengths_placeholder, audio = create_inference_graph(sigma)
+        inputs = [lc_placeholder.op.name, lc_lengths_placeholder.op.name, 'z']
+        outputs = [audio.op.name]
+
+        with tf.Session() as sess:
+            saver = tf.train.Saver(var_list=tf.trainable_variables())
+            saver.restore(sess, restore_from)
+            print('restore model successfully!')
+
+            graph_def = tf.graph_util.convert_variables_to_constants(sess, sess.graph_def, outputs)
+
+    n_nodes = len(graph_def.node)
+    graph_def = TransformGraph(graph_def, inputs, outputs, ['fold_constants(ignore_errors=true)'])
+    print('folded graph from {} to {} nodes'.format(n_nodes, len(graph_def.node)))
+
+    with tf.gfile.GFile(output, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    print('Exported frozen graph to {}'.format(output))
+
+
+def main():
+    args = get_arguments()
+    export_graph(args.restore_from, args.output, args.sigma)
+
+
+if __name__ == '__main__':
+    main()
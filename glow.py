@@ -48,13 +48,30 @@ def batch_to_time(value, dilation, name=None):
                           [tf.div(shape[0], dilation), -1, shape[2]])
 
 
-def causal_conv(value, filter_, dilation, filter_width=3, name='causal_conv'):
+DILATED_CONV_BACKENDS = ['time_to_batch', 'atrous', 'nchw']
+
+
+def causal_conv(value, filter_, dilation, filter_width=3, name='causal_conv', backend='time_to_batch'):
+    '''
+    :param value: B*T*C, or B*C*T for the nchw backend
+    :param backend: time_to_batch reshapes dilation into the batch, atrous uses the dilation of tf.nn.convolution,
+                    nchw uses the dilation of conv2d in channels first layout, which has gpu kernels only
+    '''
     with tf.name_scope(name):
         # Pad beforehand to preserve causality.
         pad = int((filter_width - 1) * dilation / 2)
+        if backend == 'nchw':
+            padded = tf.pad(value, [[0, 0], [0, 0], [pad, pad]])
+            # B*C*1*T
+            conv = tf.nn.conv2d(tf.expand_dims(padded, 2), tf.expand_dims(filter_, 0), strides=[1, 1, 1, 1],
+                                padding='VALID', data_format='NCHW', dilations=[1, 1, 1, dilation])
+            return tf.squeeze(conv, 2)[:, :, :tf.shape(value)[2]]
+
         padding = [[0, 0], [pad, pad], [0, 0]]
         padded = tf.pad(value, padding)
-        if dilation > 1:
+        if backend == 'atrous':
+            restored = tf.nn.convolution(padded, filter_, padding='VALID', dilation_rate=[dilation])
+        elif dilation > 1:
             transformed = time_to_batch(padded, dilation)
             conv = tf.nn.conv1d(transformed, filter_, stride=1, padding='VALID')
             restored = batch_to_time(conv, dilation)
@@ -67,6 +84,37 @@ def causal_conv(value, filter_, dilation, filter_width=3, name='causal_conv'):
         return result
 
 
+def subpixel_conv1d_transpose(value, filter_, stride, name='subpixel_conv'):
+    '''
+    same as tf.contrib.nn.conv1d_transpose with SAME padding, computed by a regular conv at input rate whose
+    stride * out_channels outputs are the phases of the upsampled output, instead of convolving inserted zeros.
+    with P = max(K - s, 0) // 2, y[m * s + p] = sum_j x[m - j] * w[j * s + p + P], so taps of phase p are
+    gathered from the transposed conv filter in graph, and checkpoints of the transposed conv are used as is.
+    :param value: B*L*in_channels
+    :param filter_: K*out_channels*in_channels, the filter of conv1d_transpose
+    :return: B*(L*stride)*out_channels
+    '''
+    with tf.name_scope(name):
+        width, out_channels, in_channels = filter_.get_shape().as_list()
+        pad = max(width - stride, 0) // 2
+        j_max = (width - 1 - pad) // stride
+        j_min = -((pad + stride - 1) // stride)
+        n_taps = j_max - j_min + 1
+
+        # tap t of phase p is w[j * s + p + P] with j = j_max - t, out of range taps read an extra zero row
+        taps = (j_max - np.arange(n_taps))[:, None] * stride + np.arange(stride)[None, :] + pad
+        taps = np.where((taps >= 0) & (taps < width), taps, width).astype(np.int32)
+        padded_filter = tf.pad(filter_, [[0, 1], [0, 0], [0, 0]])
+        phase_filter = tf.reshape(tf.gather(padded_filter, taps.reshape(-1)),
+                                  [n_taps, stride, out_channels, in_channels])
+        phase_filter = tf.reshape(tf.transpose(phase_filter, [0, 3, 1, 2]), [n_taps, in_channels, stride * out_channels])
+
+        padded = tf.pad(value, [[0, 0], [j_max, -j_min], [0, 0]])
+        conv = tf.nn.conv1d(padded, phase_filter, stride=1, padding='VALID')  # B*L*(s*out_channels)
+        shape = tf.shape(value)
+        return tf.reshape(conv, [shape[0], shape[1] * stride, out_channels])
+
+
 def compute_waveglow_loss(z, log_s_list, log_det_W_list, sigma=1.0):
     '''negative log-likelihood of the data x'''
     for i, log_s in enumerate(log_s_list):
@@ -101,10 +149,11 @@ def invertible1x1Conv(z, n_channels, forward=True, name='inv1x1conv'):
         W_init = np.linalg.qr(np.random.randn(n_channels, n_channels))[0].astype('float32')
         W = create_variable_init('W', initializer=W_init)
 
-        # compute log determinant
-        det = tf.log(tf.abs(tf.cast(tf.matrix_determinant(tf.cast(W, tf.float64)), tf.float32)))
-        logdet = det * tf.cast(batch_size * length, 'float32')
         if forward:
+            # compute log determinant, inference does not need it
+            det = tf.log(tf.abs(tf.cast(tf.matrix_determinant(tf.cast(W, tf.float64)), tf.float32)))
+            logdet = det * tf.cast(batch_size * length, 'float32')
+
             _W = tf.reshape(W, [1, n_channels, n_channels])
             z = tf.nn.conv1d(z, _W, stride=1, padding='SAME')
             return z, logdet
@@ -117,7 +166,8 @@ def invertible1x1Conv(z, n_channels, forward=True, name='inv1x1conv'):
 
 class WaveNet(object):
     def __init__(self, n_in_channels, n_lc_dim, n_layers,
-                 residual_channels=512, skip_channels=256, kernel_size=3, name='wavenet'):
+                 residual_channels=512, skip_channels=256, kernel_size=3, name='wavenet',
+                 lc_upsampling_rate=None):
         self.n_in_channels = n_in_channels
         self.n_lc_dim = n_lc_dim  # 80 * 8
         self.n_layers = n_layers
@@ -125,6 +175,28 @@ class WaveNet(object):
         self.skip_channels = skip_channels
         self.kernel_size = kernel_size
         self.name = name
+        # if not None, lc_batch is at frame rate, its projections are upsampled by this rate to the squeezed audio
+        self.lc_upsampling_rate = lc_upsampling_rate
+        assert hparams.dilated_conv_backend in DILATED_CONV_BACKENDS, \
+            'dilated_conv_backend should be one of {}'.format(DILATED_CONV_BACKENDS)
+        self.dilated_conv_backend = hparams.dilated_conv_backend
+        # the nchw backend keeps activations channels first through the whole network
+        self.channels_first = self.dilated_conv_backend == 'nchw'
+
+    def conv1x1(self, value, w, b):
+        if self.channels_first:
+            # bias_add does not support channels first 3-D tensors
+            return tf.nn.conv1d(value, w, 1, 'SAME', data_format='NCW') + tf.reshape(b, [-1, 1])
+        return tf.nn.bias_add(tf.nn.conv1d(value, w, 1, 'SAME'), b)
+
+    def split_channels(self, value, n):
+        '''first n channels and the others'''
+        if self.channels_first:
+            return value[:, :n, :], value[:, n:, :]
+        return value[:, :, :n], value[:, :, n:]
+
+    def lc_channels(self, lc_batch):
+        return lc_batch.get_shape().as_list()[1 if self.channels_first else -1]
 
     def create_network(self, audio_batch, lc_batch):
         with tf.variable_scope(self.name):
@@ -134,12 +206,19 @@ class WaveNet(object):
             g_s = create_variable('g_s', [self.residual_channels])
             # weight norm
             w_s = g_s * tf.nn.l2_normalize(w_s, axis=[0, 1])
-            audio_batch = tf.nn.bias_add(tf.nn.conv1d(audio_batch, w_s, 1, 'SAME'), b_s)
+            if self.channels_first:
+                audio_batch = tf.transpose(audio_batch, [0, 2, 1])
+                lc_batch = tf.transpose(lc_batch, [0, 2, 1])
+            audio_batch = self.conv1x1(audio_batch, w_s, b_s)
+
+            lc_projections = [None] * self.n_layers
+            if hparams.batch_lc_projection:
+                lc_projections = self.create_lc_projections(lc_batch)
 
             skip_outputs = []
             for i in range(self.n_layers):
                 dilation = 2 ** i
-                audio_batch, _skip_output = self.dilated_conv1d(audio_batch, lc_batch, dilation)
+                audio_batch, _skip_output = self.dilated_conv1d(audio_batch, lc_batch, dilation, lc_projections[i])
                 skip_outputs.append(_skip_output)
 
             # post process
@@ -147,10 +226,60 @@ class WaveNet(object):
             # learn scale and shift
             w_e = create_variable_zeros('w_e', [1, self.skip_channels, self.n_in_channels * 2])
             b_e = create_bias_variable('b_e', [self.n_in_channels * 2])
-            audio_batch = tf.nn.bias_add(tf.nn.conv1d(skip_output, w_e, 1, 'SAME'), b_e)
+            audio_batch = self.conv1x1(skip_output, w_e, b_e)
+            if self.channels_first:
+                audio_batch = tf.transpose(audio_batch, [0, 2, 1])
             return audio_batch[:, :, :self.n_in_channels], audio_batch[:, :, self.n_in_channels:]
 
-    def dilated_conv1d(self, audio_batch, lc_batch, dilation=1):
+    def lc_projection_weights(self, lc_channels):
+        w_lc = create_variable('w_lc', [1, self.n_lc_dim, 2 * self.residual_channels])
+        b_lc = create_bias_variable('b_lc', [2 * self.residual_channels])
+        g_lc = create_variable('g_lc', [2 * self.residual_channels])
+        # weight norm
+        w_lc = g_lc * tf.nn.l2_normalize(w_lc, [0, 1])
+
+        if self.lc_upsampling_rate is not None:
+            # a squeezed lc vector is the same frame repeated n_group times, projecting it equals
+            # projecting the frame by the sum of the n_group blocks of w_lc
+            n_group = self.n_lc_dim // lc_channels
+            w_lc = tf.reduce_sum(tf.reshape(w_lc, [n_group, lc_channels, 2 * self.residual_channels]),
+                                 axis=0, keepdims=True)
+        return w_lc, b_lc
+
+    def add_lc(self, audio_batch, lc_batch):
+        if self.lc_upsampling_rate is None:
+            return audio_batch + lc_batch
+
+        # broadcast frame rate lc over its squeezed samples instead of materializing the upsampled lc
+        shape = tf.shape(audio_batch)
+        channels = 2 * self.residual_channels
+        if self.channels_first:
+            audio_batch = tf.reshape(audio_batch, [shape[0], channels, -1, self.lc_upsampling_rate])
+            in_act = audio_batch + tf.expand_dims(lc_batch, 3)
+        else:
+            audio_batch = tf.reshape(audio_batch, [shape[0], -1, self.lc_upsampling_rate, channels])
+            in_act = audio_batch + tf.expand_dims(lc_batch, 2)
+        return tf.reshape(in_act, shape)
+
+    def create_lc_projections(self, lc_batch):
+        '''
+        every layer projects the same lc_batch by a 1x1 conv, so the weights of all layers are
+        concatenated and the projections are computed by one wide conv, then split for each layer
+        '''
+        weights = []
+        biases = []
+        for i in range(self.n_layers):
+            with tf.variable_scope('dilation_%d' % (2 ** i,)):
+                w_lc, b_lc = self.lc_projection_weights(self.lc_channels(lc_batch))
+                weights.append(w_lc)
+                biases.append(b_lc)
+
+        w_lc = tf.concat(weights, axis=2)
+        b_lc = tf.concat(biases, axis=0)
+        lc_batch = self.conv1x1(lc_batch, w_lc, b_lc)
+        return tf.split(lc_batch, self.n_layers, axis=1 if self.channels_first else 2)
+
+    def dilated_conv1d(self, audio_batch, lc_batch, dilation=1, lc_projection=None):
         input = audio_batch
         with tf.variable_scope('dilation_%d' % (dilation,)):
             # compute gate & filter
@@ -162,21 +291,21 @@ class WaveNet(object):
             w_g_f = g_g_f * tf.nn.l2_normalize(w_g_f, [0, 1])
 
             # dilated conv1d
-            audio_batch = causal_conv(audio_batch, w_g_f, dilation, self.kernel_size)
+            audio_batch = causal_conv(audio_batch, w_g_f, dilation, self.kernel_size,
+                                      backend=self.dilated_conv_backend)
 
             # process local condition
-            w_lc = create_variable('w_lc', [1, self.n_lc_dim, 2 * self.residual_channels])
-            b_lc = create_bias_variable('b_lc', [2 * self.residual_channels])
-            g_lc = create_variable('g_lc', [2 * self.residual_channels])
-            # weight norm
-            w_lc = g_lc * tf.nn.l2_normalize(w_lc, [0, 1])
-
-            lc_batch = tf.nn.bias_add(tf.nn.conv1d(lc_batch, w_lc, 1, 'SAME'), b_lc)
+            if lc_projection is None:
+                w_lc, b_lc = self.lc_projection_weights(self.lc_channels(lc_batch))
+                lc_batch = self.conv1x1(lc_batch, w_lc, b_lc)
+            else:
+                lc_batch = lc_projection
 
             # gated conv
-            in_act = audio_batch + lc_batch  # add local condtion
-            filter = tf.nn.tanh(in_act[:, :, :self.residual_channels])
-            gate = tf.nn.sigmoid(in_act[:, :, self.residual_channels:])
+            in_act = self.add_lc(audio_batch, lc_batch)  # add local condtion
+            in_filter, in_gate = self.split_channels(in_act, self.residual_channels)
+            filter = tf.nn.tanh(in_filter)
+            gate = tf.nn.sigmoid(in_gate)
             acts = gate * filter
 
             # skip
@@ -185,7 +314,7 @@ class WaveNet(object):
             g_skip = create_variable('g_skip', [self.skip_channels])
             # weight norm
             w_skip = g_skip * tf.nn.l2_normalize(w_skip, [0, 1])
-            skip_output = tf.nn.bias_add(tf.nn.conv1d(acts, w_skip, 1, 'SAME'), b_skip)
+            skip_output = self.conv1x1(acts, w_skip, b_skip)
 
             # residual conv1d
             w_res = create_variable('w_res', [1, self.residual_channels, self.residual_channels])
@@ -194,7 +323,7 @@ class WaveNet(object):
             g_res = create_variable('g_res', [self.residual_channels])
             w_res = g_res * tf.nn.l2_normalize(w_res)
 
-            res_output = tf.nn.bias_add(tf.nn.conv1d(acts, w_res, 1, 'SAME'), b_res)
+            res_output = self.conv1x1(acts, w_res, b_res)
 
             return res_output + input, skip_output
 
@@ -215,24 +344,55 @@ class WaveGlow(object):
         if hparams.transposed_upsampling:
             self.lc_dim = hparams.transposed_conv_channels
 
-    def create_lc_blstm_network(self, local_condition_batch):
+        # project lc at frame rate and upsample the projections, instead of projecting upsampled lc
+        self.lc_upsampling_rate = None
+        if hparams.lc_frame_rate_projection and not hparams.transposed_upsampling:
+            assert hparams.upsampling_rate % n_group == 0, 'upsampling rate should be multiple of n_group'
+            self.lc_upsampling_rate = hparams.upsampling_rate // n_group
+
+    def create_lc_blstm_network(self, local_condition_batch, sequence_length=None):
         lstm_size = hparams.lc_encode_size
         lstm_layers = hparams.lc_encode_layers
 
         with tf.variable_scope("lc_blstm_embedding"):
             for layer_index in range(lstm_layers):
                 with tf.variable_scope('layer_{}'.format(layer_index)):
-                    fw_cell = tf.contrib.rnn.LSTMCell(lstm_size)
-                    bw_cell = tf.contrib.rnn.LSTMCell(lstm_size)
-
-                    outputs, states = tf.nn.bidirectional_dynamic_rnn(fw_cell,
-                                                                      bw_cell,
-                                                                      local_condition_batch,
-                                                                      dtype=tf.float32)
+                    if hparams.lc_encode_fused_lstm:
+                        outputs = self.create_fused_bidirectional_rnn(local_condition_batch, lstm_size,
+                                                                      sequence_length)
+                    else:
+                        fw_cell = tf.contrib.rnn.LSTMCell(lstm_size)
+                        bw_cell = tf.contrib.rnn.LSTMCell(lstm_size)
+
+                        outputs, states = tf.nn.bidirectional_dynamic_rnn(fw_cell,
+                                                                          bw_cell,
+                                                                          local_condition_batch,
+                                                                          sequence_length=sequence_length,
+                                                                          dtype=tf.float32)
                     local_condition_batch = tf.concat(outputs, axis=2)
 
         return local_condition_batch  # B*T*(lstm_channel*2)
 
+    def create_fused_bidirectional_rnn(self, inputs, num_units, sequence_length=None):
+        '''
+        bidirectional_dynamic_rnn of LSTMCells computed by fused block lstm kernels instead of a while loop.
+        LSTMBlockFusedCell has the same kernel layout, gate order and forget bias as LSTMCell, its variables
+        are created under the names used by bidirectional_dynamic_rnn, so that checkpoints are shared
+        :return: outputs of the forward and backward rnn, B*T*num_units each
+        '''
+        inputs = tf.transpose(inputs, [1, 0, 2])  # time major
+        outputs = []
+        with tf.variable_scope('bidirectional_rnn'):
+            for direction in ['fw', 'bw']:
+                with tf.variable_scope(direction):
+                    cell = tf.contrib.rnn.LSTMBlockFusedCell(num_units)
+                    if direction == 'bw':
+                        # reverses every sequence within its length
+                        cell = tf.contrib.rnn.TimeReversedFusedRNN(cell)
+                    output, _ = cell(inputs, sequence_length=sequence_length, dtype=tf.float32, scope='lstm_cell')
+                    outputs.append(tf.transpose(output, [1, 0, 2]))
+        return outputs
+
     def create_transposed_conv1d(self, lc_batch, input_lc_dim=80):
         with tf.variable_scope('transpoed_conv'):
             # transposed conv layer 1
@@ -240,8 +400,11 @@ class WaveGlow(object):
             batch_size, lc_length, lc_dim = lc_shape[0], lc_shape[1], lc_shape[2]
             filter1 = create_variable('layer1', [hparams.transposed_conv_layer1_filter_width, hparams.transposed_conv_channels, input_lc_dim])
             stride1 = hparams.transposed_conv_layer1_stride
-            output_shape = [batch_size, lc_length * stride1, hparams.transposed_conv_channels]
-            lc_batch = tf.contrib.nn.conv1d_transpose(lc_batch, filter1, output_shape, stride=stride1)
+            if hparams.subpixel_upsampling:
+                lc_batch = subpixel_conv1d_transpose(lc_batch, filter1, stride1)
+            else:
+                output_shape = [batch_size, lc_length * stride1, hparams.transposed_conv_channels]
+                lc_batch = tf.contrib.nn.conv1d_transpose(lc_batch, filter1, output_shape, stride=stride1)
             lc_batch = tf.nn.relu(lc_batch)
 
             # transposed conv layer 2
@@ -250,42 +413,113 @@ class WaveGlow(object):
             filter2 = create_variable('layer2',
                                       [hparams.transposed_conv_layer2_filter_width, hparams.transposed_conv_channels, hparams.transposed_conv_channels])
             stride2 = hparams.transposed_conv_layer2_stride
-            output_shape = [batch_size, lc_length * stride2, hparams.transposed_conv_channels]
-            lc_batch = tf.contrib.nn.conv1d_transpose(lc_batch, filter2, output_shape, stride=stride2)
+            if hparams.subpixel_upsampling:
+                lc_batch = subpixel_conv1d_transpose(lc_batch, filter2, stride2)
+            else:
+                output_shape = [batch_size, lc_length * stride2, hparams.transposed_conv_channels]
+                lc_batch = tf.contrib.nn.conv1d_transpose(lc_batch, filter2, output_shape, stride=stride2)
             lc_batch = tf.nn.relu(lc_batch)
 
             return lc_batch
 
+    def create_upsampling_network(self, lc_batch, lc_lengths=None):
+        '''
+        encode and upsample local condition for the WaveNets
+        :param lc_batch: B*T*80
+        :param lc_lengths: B, number of valid frames of each utterance
+        :return: B*T'*(lc_dim*n_group) squeezed lc, or B*T*lc_dim frame rate lc if lc_upsampling_rate is set
+        '''
+        batch = tf.shape(lc_batch)[0]
+
+        if hparams.lc_encode:
+            # local condition bi-directional encoding
+            lc_batch = self.create_lc_blstm_network(lc_batch, sequence_length=lc_lengths)
+
+        if hparams.transposed_upsampling:
+            # upsampling by transposed conv
+            input_lc_dim = self.mel_dim
+            if hparams.lc_encode:
+                input_lc_dim = hparams.lc_encode_size * 2
+
+            lc_batch = self.create_transposed_conv1d(lc_batch, input_lc_dim)
+        else:
+            if self.lc_upsampling_rate is not None:
+                # upsampled after projection by WaveNet
+                return lc_batch
+
+            # up-sampling in tf code by directly copy
+            lc_batch = tf.tile(lc_batch, [1, 1, hparams.upsampling_rate])
+            lc_batch = tf.reshape(lc_batch, [batch, -1, self.lc_dim])
+
+        # need to make sure that length of lc_batch be multiple times of n_group
+        pad = self.n_group - 1 - (tf.shape(lc_batch)[1] + self.n_group - 1) % self.n_group
+        lc_batch = tf.pad(lc_batch, [[0, 0], [0, pad], [0, 0]])
+        lc_batch = tf.reshape(lc_batch, [batch, -1, self.lc_dim * self.n_group])  # B*T'*640
+        return lc_batch
+
+    def create_flow(self, audio_batch, lc_batch, n_channels):
+        '''
+        invertible 1x1 conv followed by affine coupling layer
+        :return: output of the flow, log_s of the coupling layer and log det of 1x1 conv weights
+        '''
+        # invertiable 1X1 conv
+        audio_batch, log_det_w = invertible1x1Conv(audio_batch, n_channels)
+
+        # affine coupling layer
+        n_half = int(n_channels / 2)
+        audio_0, audio_1 = audio_batch[:, :, :n_half], audio_batch[:, :, n_half:]
+
+        wavenet = WaveNet(n_half, self.lc_dim * self.n_group, hparams.n_layers,
+                          hparams.residual_channels, hparams.skip_channels,
+                          lc_upsampling_rate=self.lc_upsampling_rate)
+        log_s, shift = wavenet.create_network(audio_0, lc_batch)
+        audio_1 = audio_1 * tf.exp(log_s) + shift
+        audio_batch = tf.concat([audio_0, audio_1], axis=-1)
+        return audio_batch, log_s, log_det_w
+
+    def create_recomputed_flow(self, audio_batch, lc_batch, n_channels):
+        '''
+        same as create_flow, but WaveNet activations are not kept for backprop, the flow is
+        recomputed from its input in the backward pass. only the flow input is stored, which is
+        B*T'*n_channels, instead of the B*T'*residual_channels activations of every WaveNet layer.
+        custom_gradient needs resource variables, see create_forward_network
+        '''
+        scope = tf.get_variable_scope()
+
+        @tf.custom_gradient
+        def flow(audio_batch, lc_batch):
+            outputs = self.create_flow(audio_batch, lc_batch, n_channels)
+
+            def grad(d_audio, d_log_s, d_log_det_w, variables=None):
+                variables = list(variables or [])
+                with tf.variable_scope(scope, reuse=True):
+                    recomputed = self.create_flow(audio_batch, lc_batch, n_channels)
+                grads = tf.gradients(recomputed, [audio_batch, lc_batch] + variables,
+                                     grad_ys=[d_audio, d_log_s, d_log_det_w])
+                return grads[:2], grads[2:]
+
+            return outputs, grad
+
+        return flow(audio_batch, lc_batch)
+
     def create_forward_network(self, audio_batch, lc_batch, name='Waveglow'):
         '''
         :param audio_batch: B*T*1
-        :param lc_batch: B*T*80, upsampled by directly repeat or transposed conv
+        :param lc_batch: B*T*80 frames, upsampled in graph by directly repeat or transposed conv
         :param name:
         :return:
         '''
-        with tf.variable_scope(name):
+        # variables used inside tf.custom_gradient must be resource variables,
+        # their checkpoints are compatible with the default ones
+        use_resource = True if hparams.recompute_flow_activations else None
+        with tf.variable_scope(name, use_resource=use_resource):
             # TODO: make local condition interleveled in each dimension
             batch, length = tf.shape(audio_batch)[0], tf.shape(audio_batch)[1]
 
-            if hparams.lc_encode:
-                # local condition bi-directional encoding
-                lc_batch = self.create_lc_blstm_network(lc_batch)
-
-            if hparams.transposed_upsampling:
-                # upsampling by transposed conv
-                input_lc_dim = self.mel_dim
-                if hparams.lc_encode:
-                    input_lc_dim = hparams.lc_encode_size * 2
-
-                lc_batch = self.create_transposed_conv1d(lc_batch, input_lc_dim)
-            elif hparams.lc_encode and hparams.transposed_upsampling is False:
-                # up-sampling in tf code by directly copy
-                lc_batch = tf.tile(lc_batch, [1, 1, hparams.upsampling_rate])
-                lc_batch = tf.reshape(lc_batch, [batch, -1, self.lc_dim])
+            lc_batch = self.create_upsampling_network(lc_batch)
 
             # sequeeze
             audio_batch = tf.reshape(audio_batch, [batch, -1, self.n_group])  # B*T'*8
-            lc_batch = tf.reshape(lc_batch, [batch, -1, self.lc_dim * self.n_group])  # B*T'*640
 
             output_audio = []
             log_s_list = []
@@ -298,58 +532,48 @@ class WaveGlow(object):
                     self.n_remaining_channels -= self.n_early_size  # update remaining channels
 
                 with tf.variable_scope('glow_%d' % (k,)):
-                    # invertiable 1X1 conv
-                    audio_batch, log_det_w = invertible1x1Conv(audio_batch, self.n_remaining_channels)
+                    if hparams.recompute_flow_activations:
+                        audio_batch, log_s, log_det_w = self.create_recomputed_flow(
+                            audio_batch, lc_batch, self.n_remaining_channels)
+                    else:
+                        audio_batch, log_s, log_det_w = self.create_flow(
+                            audio_batch, lc_batch, self.n_remaining_channels)
                     log_det_W_list.append(log_det_w)
-
-                    # affine coupling layer
-                    n_half = int(self.n_remaining_channels / 2)
-                    audio_0, audio_1 = audio_batch[:, :, :n_half], audio_batch[:, :, n_half:]
-
-                    wavenet = WaveNet(n_half, self.lc_dim * self.n_group, hparams.n_layers,
-                                      hparams.residual_channels, hparams.skip_channels)
-                    log_s, shift = wavenet.create_network(audio_0, lc_batch)
-                    audio_1 = audio_1 * tf.exp(log_s) + shift
-                    audio_batch = tf.concat([audio_0, audio_1], axis=-1)
-
                     log_s_list.append(log_s)
 
             output_audio.append(audio_batch)
             return tf.concat(output_audio, axis=-1), log_s_list, log_det_W_list
 
-    def infer(self, lc_batch, sigma=1.0, name='Waveglow'):
+    def infer(self, lc_batch, sigma=1.0, name='Waveglow', lc_lengths=None, z=None):
+        '''
+        :param lc_batch: B*T*80, frames of zero padded utterances
+        :param sigma:
+        :param name:
+        :param lc_lengths: B, number of valid frames of each utterance, so that padding does not
+                           leak into the backward direction of the bi-lstm encoder
+        :param z: B*(T*upsampling_rate/n_group)*n_group standard normal latent, channel c of squeezed
+                  step t is scaled by sigma into audio sample t*n_group+c, drawn in graph if not given
+        :return: B*T'*1
+        '''
         with tf.variable_scope(name):
-            batch = tf.shape(lc_batch)[0]
             # compute the remaining channels
             remaining_channels = self.n_group
             for k in range(0, self.n_flows):
                 if k % self.n_early_every == 0 and k > 0:
                     remaining_channels = remaining_channels - self.n_early_size
 
-            if hparams.lc_encode:
-                # local condition bi-directional encoding
-                lc_batch = self.create_lc_blstm_network(lc_batch)
-
-            if hparams.transposed_upsampling:
-                # upsampling by transposed conv
-                input_lc_dim = self.mel_dim
-                if hparams.lc_encode:
-                    input_lc_dim = hparams.lc_encode_size * 2
-
-                lc_batch = self.create_transposed_conv1d(lc_batch, input_lc_dim)
-            elif hparams.lc_encode and hparams.transposed_upsampling is False:
-                # up-sampling in tf code by directly copy
-                lc_batch = tf.tile(lc_batch, [1, 1, hparams.upsampling_rate])
-                lc_batch = tf.reshape(lc_batch, [batch, -1, self.lc_dim])
-
-            # need to make sure that length of lc_batch be multiple times of n_group
-            pad = self.n_group - 1 - (tf.shape(lc_batch)[1] + self.n_group - 1) % self.n_group
-            lc_batch = tf.pad(lc_batch, [[0, 0], [0, pad], [0, 0]])
-            lc_batch = tf.reshape(lc_batch, [batch, -1, self.lc_dim * self.n_group])
+            lc_batch = self.create_upsampling_network(lc_batch, lc_lengths)
 
+            # length of the squeezed audio
             shape = tf.shape(lc_batch)
-            audio_batch = tf.random_normal([shape[0], tf.shape(lc_batch)[1], remaining_channels])
-            audio_batch = audio_batch * sigma
+            length = shape[1]
+            if self.lc_upsampling_rate is not None:
+                length = length * self.lc_upsampling_rate
+
+            if z is None:
+                z = tf.random_normal([shape[0], length, self.n_group])
+            audio_batch = z[:, :, :remaining_channels] * sigma
+            n_drawn = remaining_channels
 
             # backward inference
             for k in reversed(range(0, self.n_flows)):
@@ -358,7 +582,8 @@ class WaveGlow(object):
                     n_half = int(remaining_channels / 2)
                     audio_0, audio_1 = audio_batch[:, :, :n_half], audio_batch[:, :, n_half:]
                     wavenet = WaveNet(n_half, self.lc_dim * self.n_group, hparams.n_layers,
-                                      hparams.residual_channels, hparams.skip_channels)
+                                      hparams.residual_channels, hparams.skip_channels,
+                                      lc_upsampling_rate=self.lc_upsampling_rate)
                     log_s, shift = wavenet.create_network(audio_0, lc_batch)
                     audio_1 = (audio_1 - shift) / tf.exp(log_s)
                     audio_batch = tf.concat([audio_0, audio_1], axis=-1)
@@ -368,11 +593,11 @@ class WaveGlow(object):
 
                 # early output
                 if k % self.n_early_every == 0 and k > 0:
-                    z = tf.random_normal([shape[0], tf.shape(lc_batch)[1], self.n_early_size])
-                    z = z * sigma
+                    early_z = z[:, :, n_drawn:n_drawn + self.n_early_size] * sigma
+                    n_drawn += self.n_early_size
                     remaining_channels += self.n_early_size
 
-                    audio_batch = tf.concat([z, audio_batch], axis=-1)
+                    audio_batch = tf.concat([early_z, audio_batch], axis=-1)
 
             # reshape audio back to B*T*1
             audio_batch = tf.reshape(audio_batch, [shape[0], -1, 1])
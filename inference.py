@@ -1,13 +1,28 @@
 import tensorflow as tf
 import numpy as np
 from scipy.io import wavfile
-from data_reader import read_binary_lc
+from data_reader import read_binary_lc, read_filelist
+from tensorflow.python.client import timeline
 import argparse
 import os
+import time
+import wave
+import collections
+import queue
+import re
+import threading
 from params import hparams
 from glow import WaveGlow
 
 
+# the bi-lstm encoder has unbounded context, give it some extra lc frames when chunking
+BLSTM_CONTEXT_FRAMES = 32
+
+# name scopes whose op time is reported by --profile
+PROFILE_SCOPES = [r'glow_\d+', r'dilation_\d+', 'lc_blstm_embedding', 'transpoed_conv', 'inv1x1conv',
+                  'time_to_batch', 'batch_to_time']
+
+
 def get_arguments():
     def _str_to_bool(s):
         """Convert string to bool (in argparse context)."""
@@ -17,13 +32,42 @@ def get_arguments():
         return {'true': True, 'false': False}[s.lower()]
 
     parser = argparse.ArgumentParser(description='Parallel WaveNet Network')
-    parser.add_argument('--lc', type=str, default=None, required=True,
+    parser.add_argument('--lc', type=str, default=None,
                         help='local condition file')
     parser.add_argument('--wave_name', type=str, default='waveglow.wav')
+    parser.add_argument('--scp', type=str, default=None,
+                        help='filelist of utterance ids to synthesize in batches, instead of --lc')
+    parser.add_argument('--lc_dir', type=str, default=None,
+                        help='local condition directory for utterances in --scp')
+    parser.add_argument('--output_dir', type=str, default='.',
+                        help='directory where to save waves synthesized from --scp')
+    parser.add_argument('--batch_size', type=int, default=8,
+                        help='max number of utterances synthesized by one run')
+    parser.add_argument('--max_batch_frames', type=int, default=None,
+                        help='max number of padded lc frames in one batch')
     parser.add_argument('--restore_from', type=str, default=None,
                         help='restore model from checkpoint')
+    parser.add_argument('--frozen_graph', type=str, default=None,
+                        help='load the graph written by export_graph.py instead of --restore_from')
     parser.add_argument('--sigma', type=float, default=0.6,
                         help='sigma value for inference')
+    parser.add_argument('--chunk_frames', type=int, default=0,
+                        help='synthesize in chunks of this many lc frames and write audio as it goes, '
+                             '0 means synthesizing the whole utterance at once')
+    parser.add_argument('--context_frames', type=int, default=None,
+                        help='extra lc frames fed on each side of a chunk, '
+                             'default covers the receptive field of the network')
+    parser.add_argument('--crossfade_frames', type=int, default=4,
+                        help='lc frames crossfaded between adjacent chunks')
+    parser.add_argument('--profile', type=_str_to_bool, default=False,
+                        help='Whether to profile synthesis of --lc or of every utterance in --scp, '
+                             'instead of writing waves')
+    parser.add_argument('--profile_warmup', type=int, default=2,
+                        help='untraced runs before profiling')
+    parser.add_argument('--profile_iterations', type=int, default=3,
+                        help='traced runs averaged by the profile')
+    parser.add_argument('--profile_dir', type=str, default=None,
+                        help='if specified, save a chrome trace of every profiled utterance here')
     return parser.parse_args()
 
 
@@ -42,37 +86,392 @@ def write_wav(waveform, sample_rate, filename):
     print('Updated wav file at {}'.format(filename))
 
 
+def prepare_lc(lc):
+    '''convert lc frames T*80 or B*T*80 to the layout expected by the lc placeholder'''
+    if lc.ndim == 2:
+        lc = np.expand_dims(lc, 0)
+    # lc is upsampled in graph
+    return lc
+
+
+def create_inference_graph(sigma):
+    '''
+    :return: lc placeholder B*T*80, lc lengths placeholder B (defaults to T for every utterance)
+             and the synthesized audio B*T'*1.
+             the latent is fed by the z placeholder of B*(T*upsampling_rate/n_group)*n_group,
+             which defaults to a new draw by every run
+    '''
+    glow = WaveGlow(lc_dim=hparams.num_mels,
+                    n_flows=hparams.n_flows,
+                    n_group=hparams.n_group,
+                    n_early_every=hparams.n_early_every,
+                    n_early_size=hparams.n_early_size)
+
+    lc_placeholder = tf.placeholder(tf.float32, shape=[None, None, hparams.num_mels], name='lc')
+    lc_shape = tf.shape(lc_placeholder)
+    lc_lengths_placeholder = tf.placeholder_with_default(tf.fill([lc_shape[0]], lc_shape[1]),
+                                                         shape=[None], name='lc_lengths')
+    z_placeholder = tf.placeholder_with_default(
+        tf.random_normal([lc_shape[0], lc_shape[1] * (hparams.upsampling_rate // hparams.n_group), hparams.n_group]),
+        shape=[None, None, hparams.n_group], name='z')
+    audio = glow.infer(lc_placeholder, sigma=sigma, lc_lengths=lc_lengths_placeholder, z=z_placeholder)
+    audio = tf.identity(audio, name='audio')
+    return lc_placeholder, lc_lengths_placeholder, audio
+
+
+def load_frozen_graph(frozen_graph):
+    '''import a graph written by export_graph.py, no checkpoint restoring is needed'''
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(frozen_graph, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    lc_placeholder, lc_lengths_placeholder, audio = tf.import_graph_def(
+        graph_def, return_elements=['lc:0', 'lc_lengths:0', 'audio:0'], name='')
+    return lc_placeholder, lc_lengths_placeholder, audio
+
+
+def load_model(restore_from=None, frozen_graph=None, sigma=0.6):
+    '''
+    build the inference graph and restore it from checkpoint, or load a frozen graph
+    :return: session, lc placeholder, lc lengths placeholder and audio tensor
+    '''
+    if frozen_graph is not None:
+        print('load frozen graph {}, sigma is fixed at export time'.format(frozen_graph))
+        lc_placeholder, lc_lengths_placeholder, audio = load_frozen_graph(frozen_graph)
+        sess = tf.Session(config=tf.ConfigProto(log_device_placement=False, allow_soft_placement=True))
+        return sess, lc_placeholder, lc_lengths_placeholder, audio
+
+    lc_placeholder, lc_lengths_placeholder, audio = create_inference_graph(sigma)
+
+    sess = tf.Session(config=tf.ConfigProto(log_device_placement=False, allow_soft_placement=True))
+    print("restore model")
+    saver = tf.train.Saver(var_list=tf.trainable_variables())
+    saver.restore(sess, restore_from)
+    print('restore model successfully!')
+    return sess, lc_placeholder, lc_lengths_placeholder, audio
+
+
+def pad_lc_batch(lc_list):
+    '''zero pad a list of T_i*80 lc to B*max(T_i)*80'''
+    max_frames = max(len(lc) for lc in lc_list)
+    batch = np.zeros([len(lc_list), max_frames, hparams.num_mels], dtype=np.float32)
+    for i, lc in enumerate(lc_list):
+        batch[i, :len(lc), :] = lc
+    return batch
+
+
+def make_length_buckets(lengths, batch_size, max_batch_frames=None):
+    '''
+    group utterance indices into batches of similar length, so that little padding is wasted
+    :return: list of lists of indices into lengths
+    '''
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    buckets = []
+    bucket = []
+    for i in order:
+        # lengths are sorted, so lengths[i] is the padded length of the bucket
+        if bucket and (len(bucket) >= batch_size or
+                       (max_batch_frames is not None and (len(bucket) + 1) * lengths[i] > max_batch_frames)):
+            buckets.append(bucket)
+            bucket = []
+        bucket.append(i)
+    if bucket:
+        buckets.append(bucket)
+    return buckets
+
+
+def receptive_field_frames():
+    '''number of lc frames on each side that can influence the output of one frame'''
+    # every flow runs a WaveNet of non-causal dilated convs over the squeezed audio
+    wavenet_context = (hparams.kernel_size - 1) // 2 * (2 ** hparams.n_layers - 1)
+    samples = hparams.n_flows * wavenet_context * hparams.n_group
+    frames = -(-samples // hparams.upsampling_rate)
+
+    if hparams.transposed_upsampling:
+        frames += -(-hparams.transposed_conv_layer1_filter_width // hparams.transposed_conv_layer1_stride)
+        # context of layer2 is less than one frame
+        frames += 1
+
+    if hparams.lc_encode:
+        frames += BLSTM_CONTEXT_FRAMES
+
+    return frames
+
+
+def synthesize_streaming(sess, audio, lc_placeholder, lc, wave_name,
+                         chunk_frames, context_frames, crossfade_frames):
+    '''
+    synthesize lc chunk by chunk, each chunk is fed with context_frames extra frames on both sides,
+    adjacent chunks are linearly crossfaded over crossfade_frames and pcm is appended to wave_name.
+    the latent is drawn once for the utterance and every chunk is fed its slice, so that the
+    overlapping samples of adjacent chunks are synthesized from the same latent
+    '''
+    hop = hparams.upsampling_rate
+    n_frames = len(lc)
+    crossfade_frames = min(crossfade_frames, context_frames)
+
+    try:
+        z_placeholder = audio.graph.get_tensor_by_name('z:0')
+        steps_per_frame = hop // hparams.n_group
+        z = np.random.normal(size=[1, n_frames * steps_per_frame, hparams.n_group]).astype(np.float32)
+    except KeyError:
+        # frozen graph exported before the latent could be fed
+        print('the graph has no z input, every chunk draws its own latent')
+        z_placeholder = None
+
+    writer = wave.open(wave_name, 'wb')
+    writer.setnchannels(1)
+    writer.setsampwidth(2)
+    writer.setframerate(hparams.sample_rate)
+
+    start_time = time.time()
+    pending = None  # tail of the previous chunk, crossfaded into the head of the current chunk
+    try:
+        for chunk_start in range(0, n_frames, chunk_frames):
+            chunk_end = min(chunk_start + chunk_frames, n_frames)
+            left = max(0, chunk_start - context_frames)
+            right = min(n_frames, chunk_end + context_frames)
+
+            chunk_time = time.time()
+            feed_dict = {lc_placeholder: prepare_lc(lc[left:right])}
+            if z_placeholder is not None:
+                feed_dict[z_placeholder] = z[:, left * steps_per_frame:right * steps_per_frame]
+            output = sess.run(audio, feed_dict=feed_dict)
+            compute_time = time.time() - chunk_time
+
+            # keep the chunk itself and the tail which overlaps the next chunk
+            keep_end = min(chunk_end + crossfade_frames, right)
+            output = output.flatten()[(chunk_start - left) * hop:(keep_end - left) * hop]
+
+            if pending is not None and len(pending) > 0:
+                n = len(pending)
+                fade = (np.arange(n, dtype=np.float32) + 0.5) / n
+                output[:n] = pending * (1. - fade) + output[:n] * fade
+
+            pending = None
+            if chunk_end < n_frames:
+                tail_start = (chunk_end - chunk_start) * hop
+                pending = output[tail_start:]
+                output = output[:tail_start]
+
+            pcm = np.clip(output, -1., 1.) * 32767
+            writer.writeframes(pcm.astype(np.int16).tobytes())
+
+            if chunk_start == 0:
+                print('time to first audio: {:.3f}s'.format(time.time() - start_time))
+            print('chunk frames [{:d}, {:d}) - time cost={:.3f}s, rtf={:.3f}'
+                  .format(chunk_start, chunk_end, compute_time,
+                          compute_time / (len(output) / float(hparams.sample_rate))))
+    finally:
+        writer.close()
+
+    total_time = time.time() - start_time
+    print('synthesized {:.2f}s audio in {:.3f}s, rtf={:.3f}'
+          .format(n_frames * hop / float(hparams.sample_rate), total_time,
+                  total_time / (n_frames * hop / float(hparams.sample_rate))))
+    print('Updated wav file at {}'.format(wave_name))
+
+
+def wav_writer_main(write_queue, errors):
+    while True:
+        item = write_queue.get()
+        if item is None:
+            break
+        if errors:
+            # keep draining after a failure, so that the synthesis loop never blocks on a full queue
+            continue
+        waveform, filename = item
+        try:
+            write_wav(waveform, hparams.sample_rate, filename)
+        except Exception as e:
+            errors.append(e)
+
+
+def synthesize_filelist(sess, audio, lc_placeholder, lc_lengths_placeholder, filelist, lc_dir, output_dir,
+                        batch_size, max_batch_frames=None):
+    '''synthesize every utterance of filelist, utterances of similar length are synthesized in one batch'''
+    file_ids = [file_id for file_id in read_filelist(filelist) if file_id]
+    lcs = [read_binary_lc(os.path.join(lc_dir, file_id + '.mel'), hparams.num_mels) for file_id in file_ids]
+    buckets = make_length_buckets([len(lc) for lc in lcs], batch_size, max_batch_frames)
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    # write waves in background, so that the session is not idle while writing
+    write_queue = queue.Queue(maxsize=2 * batch_size)
+    writer_errors = []
+    writer = threading.Thread(target=wav_writer_main, args=(write_queue, writer_errors))
+    writer.daemon = True
+    writer.start()
+
+    total_time = 0.
+    total_samples = 0
+    try:
+        for bucket in buckets:
+            lc_batch = pad_lc_batch([lcs[i] for i in bucket])
+            lc_lengths = np.array([len(lcs[i]) for i in bucket], dtype=np.int32)
+
+            start_time = time.time()
+            audio_output = sess.run(audio, feed_dict={lc_placeholder: prepare_lc(lc_batch),
+                                                      lc_lengths_placeholder: lc_lengths})
+            duration = time.time() - start_time
+
+            batch_samples = 0
+            for b, i in enumerate(bucket):
+                # trim the padding away
+                n_samples = len(lcs[i]) * hparams.upsampling_rate
+                waveform = audio_output[b, :n_samples, 0]
+                if writer_errors:
+                    raise writer_errors[0]
+                write_queue.put((waveform, os.path.join(output_dir, file_ids[i] + '.wav')))
+                batch_samples += n_samples
+
+            total_time += duration
+            total_samples += batch_samples
+            print('batch of {:d} utterances, {:d} frames - time cost={:.3f}s, rtf={:.3f}'
+                  .format(len(bucket), lc_batch.shape[1], duration,
+                          duration / (batch_samples / float(hparams.sample_rate))))
+    finally:
+        write_queue.put(None)
+        writer.join()
+    if writer_errors:
+        raise writer_errors[0]
+
+    if total_samples > 0:
+        print('synthesized {:d} utterances in {:.3f}s, rtf={:.3f}'
+              .format(len(file_ids), total_time, total_time / (total_samples / float(hparams.sample_rate))))
+
+
+def aggregate_op_time(step_stats, patterns=PROFILE_SCOPES):
+    '''
+    sum of op microseconds by name scope, e.g. glow_3 or dilation_4, and of all ops as total.
+    a variable scope entered twice gets a uniquified name scope, e.g. dilation_4_1 as create_lc_projections
+    enters dilation_4 before dilated_conv1d does, which is counted as dilation_4
+    '''
+    totals = collections.defaultdict(int)
+    for dev_stats in step_stats.dev_stats:
+        # on gpu, kernels of every stream are also listed under stream:all
+        if '/stream:' in dev_stats.device and not dev_stats.device.endswith('stream:all'):
+            continue
+        for node_stats in dev_stats.node_stats:
+            micros = node_stats.all_end_rel_micros
+            totals['total'] += micros
+            for pattern in patterns:
+                match = re.search(r'(?:^|/)(' + pattern + r')(?:_\d+)?(?:/|$)', node_stats.node_name)
+                if match:
+                    totals[match.group(1)] += micros
+    return totals
+
+
+def allocator_peak_bytes(step_stats):
+    peaks = {}
+    for dev_stats in step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            for memory in node_stats.memory:
+                peaks[memory.allocator_name] = max(peaks.get(memory.allocator_name, 0), memory.peak_bytes)
+    return peaks
+
+
+def scope_sort_key(scope):
+    # glow_2 before glow_10
+    name, _, index = scope.rpartition('_')
+    return (name, int(index)) if index.isdigit() else (scope, -1)
+
+
+def profile_synthesis(sess, audio, lc_placeholder, utterances, warmup, iterations, profile_dir=None):
+    '''
+    trace synthesis of every (name, lc) utterance after warmup runs, print wall time, rtf, peak memory
+    and op time by name scope per run
+    '''
+    run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+    for name, lc in utterances:
+        feed_dict = {lc_placeholder: prepare_lc(lc)}
+        audio_seconds = len(lc) * hparams.upsampling_rate / float(hparams.sample_rate)
+        for _ in range(warmup):
+            sess.run(audio, feed_dict=feed_dict)
+
+        wall_time = 0.
+        op_time = collections.defaultdict(int)
+        peaks = {}
+        for _ in range(iterations):
+            run_metadata = tf.RunMetadata()
+            start_time = time.time()
+            sess.run(audio, feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)
+            wall_time += time.time() - start_time
+            for scope, micros in aggregate_op_time(run_metadata.step_stats).items():
+                op_time[scope] += micros
+            for allocator, peak in allocator_peak_bytes(run_metadata.step_stats).items():
+                peaks[allocator] = max(peaks.get(allocator, 0), peak)
+        wall_time /= iterations
+
+        try:
+            import resource
+            # ru_maxrss is in kilobytes on linux, and the peak of the process so far
+            peak_rss = '{:.1f}MB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.)
+        except ImportError:
+            # not available on windows
+            peak_rss = 'unknown'
+        print('{}: {:d} frames, wall time={:.3f}s, rtf={:.3f}, peak rss={}, {}'
+              .format(name, len(lc), wall_time, wall_time / audio_seconds, peak_rss,
+                      ', '.join('peak {}={:.1f}MB'.format(k, v / 1024. / 1024.) for k, v in sorted(peaks.items()))))
+        # ops run in parallel, so op time of scopes may add up to more than the wall time
+        total = max(op_time['total'], 1)
+        for scope in sorted(op_time, key=scope_sort_key):
+            if scope == 'total':
+                continue
+            print('    {:>20s}: {:9.3f}ms per run, {:5.1f}% of op time'
+                  .format(scope, op_time[scope] / 1000. / iterations, 100. * op_time[scope] / total))
+        print('    {:>20s}: {:9.3f}ms per run'.format('all ops', op_time['total'] / 1000. / iterations))
+        # every WaveNet layer runs in every flow, a layer without time means ops are attributed to the wrong scope
+        missing = ['dilation_%d' % 2 ** i for i in range(hparams.n_layers) if op_time['dilation_%d' % 2 ** i] <= 0]
+        assert not missing, 'no op time attributed to {}'.format(', '.join(missing))
+
+        if profile_dir is not None:
+            if not os.path.exists(profile_dir):
+                os.makedirs(profile_dir)
+            trace_path = os.path.join(profile_dir, os.path.basename(name) + '.timeline.json')
+            with open(trace_path, 'w') as f:
+                f.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format(show_memory=True))
+            print('    chrome trace saved to {}'.format(trace_path))
+
+
 def main():
     try:
         args = get_arguments()
+        if (args.lc is None) == (args.scp is None):
+            raise ValueError('one of --lc and --scp should be specified')
+        if args.scp is not None and args.lc_dir is None:
+            raise ValueError('--lc_dir should be specified with --scp, the lc of every utterance is read from it')
 
-        lc = read_binary_lc(args.lc, hparams.num_mels)
-
-        if hparams.lc_encode or hparams.transposed_upsampling:
-            lc = np.reshape(lc, [1, -1, hparams.num_mels])
-        else:
-            # upsampling local condition
-            lc = np.tile(lc, [1, 1, hparams.upsampling_rate])
-            lc = np.reshape(lc, [1, -1, hparams.num_mels])
+        sess, lc_placeholder, lc_lengths_placeholder, audio = load_model(args.restore_from, args.frozen_graph,
+                                                                         args.sigma)
 
-        print(lc.shape)
+        if args.profile:
+            if args.scp is not None:
+                utterances = [(file_id, read_binary_lc(os.path.join(args.lc_dir, file_id + '.mel'), hparams.num_mels))
+                              for file_id in read_filelist(args.scp) if file_id]
+            else:
+                utterances = [(args.lc, read_binary_lc(args.lc, hparams.num_mels))]
+            profile_synthesis(sess, audio, lc_placeholder, utterances, args.profile_warmup,
+                              args.profile_iterations, args.profile_dir)
+            return
 
-        glow = WaveGlow(lc_dim=hparams.num_mels,
-                        n_flows=hparams.n_flows,
-                        n_group=hparams.n_group,
-                        n_early_every=hparams.n_early_every,
-                        n_early_size=hparams.n_early_size)
+        if args.scp is not None:
+            synthesize_filelist(sess, audio, lc_placeholder, lc_lengths_placeholder, args.scp, args.lc_dir,
+                                args.output_dir, args.batch_size, args.max_batch_frames)
+            return
 
-        lc_placeholder = tf.placeholder(tf.float32, shape=[1, None, hparams.num_mels], name='lc')
-        audio = glow.infer(lc_placeholder, sigma=args.sigma)
+        lc = read_binary_lc(args.lc, hparams.num_mels)
+        print(lc.shape)
 
-        sess = tf.Session(config=tf.ConfigProto(log_device_placement=False, allow_soft_placement=True))
-        print("restore model")
-        saver = tf.train.Saver(var_list=tf.trainable_variables())
-        saver.restore(sess, args.restore_from)
-        print('restore model successfully!')
+        if args.chunk_frames > 0:
+            context_frames = args.context_frames
+            if context_frames is None:
+                context_frames = receptive_field_frames()
+            synthesize_streaming(sess, audio, lc_placeholder, lc, args.wave_name,
+                                 args.chunk_frames, context_frames, args.crossfade_frames)
+            return
 
-        audio_output = sess.run(audio, feed_dict={lc_placeholder: lc})
+        audio_output = sess.run(audio, feed_dict={lc_placeholder: prepare_lc(lc)})
         audio_output = audio_output.flatten()
         print(audio_output)
         write_wav(audio_output, hparams.sample_rate, args.wave_name)
@@ -1,7 +1,76 @@
-import tensorflow as tf
+import json
 
 
-hparams = tf.contrib.training.HParams(
+class HParams(object):
+    '''
+    Pure python replacement of tf.contrib.training.HParams, so that reading hparams does not import
+    tensorflow, e.g. in preprocessing and data loading processes.
+    '''
+
+    def __init__(self, **kwargs):
+        self._hparam_types = {}
+        for name, value in kwargs.items():
+            self.add_hparam(name, value)
+
+    def add_hparam(self, name, value):
+        if name in self._hparam_types or hasattr(self, name):
+            raise ValueError('Hyperparameter name is reserved: %s' % name)
+        self._hparam_types[name] = type(value)
+        setattr(self, name, value)
+
+    def set_hparam(self, name, value):
+        if name not in self._hparam_types:
+            raise KeyError('Unknown hyperparameter: %s' % name)
+        setattr(self, name, self._cast(name, value))
+
+    def _cast(self, name, value):
+        param_type = self._hparam_types[name]
+        if param_type is bool:
+            if isinstance(value, str):
+                if value.lower() not in ['true', 'false', '1', '0']:
+                    raise ValueError('Could not parse %s as bool for %s' % (value, name))
+                return value.lower() in ['true', '1']
+            return bool(value)
+        # like tf.contrib.training.HParams, never silently truncate a float or reinterpret a bool
+        if param_type in [int, float] and isinstance(value, bool):
+            raise ValueError('Could not cast %r to %s for %s' % (value, param_type.__name__, name))
+        if param_type is int and isinstance(value, float):
+            raise ValueError('Could not cast %r to int for %s' % (value, name))
+        if param_type is float and isinstance(value, int) and not isinstance(value, bool):
+            return float(value)
+        if not isinstance(value, param_type):
+            return param_type(value)
+        return value
+
+    def parse(self, values):
+        '''override hparams by a comma separated string like "batch_size=2,lc_encode=false"'''
+        for item in values.split(','):
+            item = item.strip()
+            if not item:
+                continue
+            name, value = item.split('=', 1)
+            self.set_hparam(name.strip(), value.strip())
+        return self
+
+    def override_from_dict(self, values_dict):
+        for name, value in values_dict.items():
+            self.set_hparam(name, value)
+        return self
+
+    def values(self):
+        return {name: getattr(self, name) for name in self._hparam_types}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.values(), **kwargs)
+
+    def __contains__(self, name):
+        return name in self._hparam_types
+
+    def __repr__(self):
+        return 'HParams(%s)' % ', '.join('%s=%r' % item for item in sorted(self.values().items()))
+
+
+hparams = HParams(
     # Audio:
     num_mels=80,
     n_fft=2048,
@@ -19,6 +88,8 @@ hparams = tf.contrib.training.HParams(
     logdir_root='./logdir',
     decay_steps=50000,
     sigma=0.707,
+    shuffle_buffer_size=256,  # pieces shuffled before batching, so that pieces of one file spread over batches
+    recompute_flow_activations=False,  # recompute each flow in backprop instead of storing WaveNet activations
 
     # network
     sample_size=64000,
@@ -33,6 +104,7 @@ hparams = tf.contrib.training.HParams(
     lc_encode=True,
     lc_encode_layers=2,
     lc_encode_size=128,
+    lc_encode_fused_lstm=False,  # fused block lstm kernels, sharing the variables of the default LSTMCell
 
     # upsampling by transposed conv
     transposed_upsampling=False,
@@ -42,10 +114,14 @@ hparams = tf.contrib.training.HParams(
     transposed_conv_layer1_filter_width=16*5,  # filter width greater than stride, then could leverage context lc
     transposed_conv_layer2_filter_width=16*5,
     transposed_conv_channels=128,
+    subpixel_upsampling=False,  # compute the transposed convs as polyphase convs at input rate, same variables
 
     # wavenet
     n_layers=8,
     residual_channels=256,
     skip_channels=256,
     kernel_size=3,
+    batch_lc_projection=True,  # compute lc projections of all layers in a flow by one wide 1x1 conv
+    lc_frame_rate_projection=False,  # project repeat-upsampled lc at frame rate, then broadcast the projections
+    dilated_conv_backend='time_to_batch',  # time_to_batch, atrous, or nchw which is channels first and gpu only
 )
@@ -2,21 +2,26 @@
 
 import os
 import glob
+import time
+import zlib
+import traceback
 import numpy as np
 import multiprocessing as mp
 from multiprocessing import Pool
 import librosa
-from audio_utils import melspectrogram
+from audio_utils import melspectrogram_batch, feature_fingerprint
 import argparse
 from params import hparams
 import random
 import codecs
+import json
+from data_reader import read_binary_lc, force_align
 
 
 def extract_melspectrum(wave_file, save_path, sr):
     try:
         y, _ = librosa.load(wave_file, sr=sr, mono=True)
-        mel_spec = melspectrogram(y)
+        mel_spec = melspectrogram_batch([y])[0]
         data = np.array(mel_spec, 'float32')
         fid = open(save_path, 'wb')
         data.tofile(fid)
@@ -40,6 +45,74 @@ def extract_mfcc(wave_file, save_path, sr, n_mfcc):
         raise
 
 
+def load_aligned(wave_file, mel_file):
+    y, _ = librosa.load(wave_file, sr=hparams.sample_rate, mono=True)
+    lc = read_binary_lc(mel_file, hparams.num_mels)
+    audio, lc = force_align(y.reshape(-1, 1), lc, hparams.upsampling_rate)
+    return audio.reshape(-1), lc
+
+
+def _load_aligned(args):
+    return load_aligned(*args)
+
+
+def pack_shards(filelist, wave_dir, mel_dir, shard_dir, audio_dtype='int16', shard_size_mb=512):
+    '''
+    pack resampled audio and float16 lc of filelist into raw shard files, force aligned once,
+    index.json records the shard, offsets and frames of every file, see data_reader.ShardReader
+    '''
+    assert audio_dtype in ['int16', 'float16'], 'audio should be packed as int16 or float16'
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+
+    shard_bytes = shard_size_mb * 1024 * 1024
+    entries = []
+    shard = -1
+    audio_file = lc_file = None
+    audio_offset = lc_offset = 0
+
+    p = Pool(mp.cpu_count())
+    jobs = [(os.path.join(wave_dir, f_name + '.wav'), os.path.join(mel_dir, f_name + '.mel')) for f_name in filelist]
+    try:
+        for f_name, (audio, lc) in zip(filelist, p.imap(_load_aligned, jobs)):
+            if audio_file is None or audio_offset * np.dtype(audio_dtype).itemsize >= shard_bytes:
+                if audio_file is not None:
+                    audio_file.close()
+                    lc_file.close()
+                shard += 1
+                prefix = os.path.join(shard_dir, 'shard_%05d' % shard)
+                audio_file = open(prefix + '.audio', 'wb')
+                lc_file = open(prefix + '.lc', 'wb')
+                audio_offset = lc_offset = 0
+
+            if audio_dtype == 'int16':
+                audio = np.clip(audio * 32768, -32768, 32767).astype(np.int16)
+            else:
+                audio = audio.astype(np.float16)
+            audio.tofile(audio_file)
+            lc.astype(np.float16).tofile(lc_file)
+
+            entries.append({'id': f_name, 'shard': shard, 'audio_offset': audio_offset,
+                            'lc_offset': lc_offset, 'frames': len(lc)})
+            audio_offset += audio.size
+            lc_offset += lc.size
+    finally:
+        p.close()
+        p.join()
+        if audio_file is not None:
+            audio_file.close()
+            lc_file.close()
+
+    index = {'sample_rate': hparams.sample_rate,
+             'num_mels': hparams.num_mels,
+             'hop_length': hparams.upsampling_rate,
+             'audio_dtype': audio_dtype,
+             'files': entries}
+    with codecs.open(os.path.join(shard_dir, 'index.json'), 'w', 'utf-8') as f:
+        json.dump(index, f)
+    print('packed {} files into {} shards'.format(len(entries), shard + 1))
+
+
 def gen_filelist(filelist, save_dir):
     random.shuffle(filelist)
     # random select 200 ids as test
@@ -63,29 +136,115 @@ def gen_filelist(filelist, save_dir):
             f.write('\n')
 
 
+def file_stat(wave_file, fingerprint):
+    stat = os.stat(wave_file)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'fingerprint': fingerprint}
+
+
+def load_manifests(mel_dir):
+    '''merge the manifests of every shard run, they record the source wave of every extracted mel'''
+    manifest = {}
+    for path in sorted(glob.glob(os.path.join(mel_dir, 'manifest*.json'))):
+        with codecs.open(path, 'r', 'utf-8') as f:
+            manifest.update(json.load(f))
+    return manifest
+
+
+def save_manifest(manifest, path):
+    tmp_path = path + '.tmp'
+    with codecs.open(tmp_path, 'w', 'utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+def in_shard(f_name, shard_index, n_shards):
+    # hash file names, so that adding files does not move other files between shards
+    return zlib.crc32(f_name.encode('utf-8')) % n_shards == shard_index
+
+
+def _extract_job(job):
+    f_name, wave_file, mel_save_path, stat = job
+    try:
+        extract_melspectrum(wave_file, mel_save_path, hparams.sample_rate)
+        return f_name, stat, None
+    except Exception:
+        return f_name, stat, traceback.format_exc()
+
+
 def main(args):
-    wave_files = glob.glob(os.path.join(args.wave_dir, '*.wav'))
-    p = Pool(mp.cpu_count())
+    shard_index, n_shards = 0, 1
+    if args.shard is not None:
+        shard_index, n_shards = [int(x) for x in args.shard.split('/')]
+        assert 0 <= shard_index < n_shards, 'shard should be i/N with 0 <= i < N'
+
+    wave_files = sorted(glob.glob(os.path.join(args.wave_dir, '*.wav')))
+    fingerprint = feature_fingerprint()
+    manifest = load_manifests(args.mel_dir)
+    if n_shards > 1:
+        manifest_path = os.path.join(args.mel_dir, 'manifest.{}-of-{}.json'.format(shard_index, n_shards))
+    else:
+        manifest_path = os.path.join(args.mel_dir, 'manifest.json')
+    shard_manifest = {}
 
-    results = []
+    jobs = []
     filelist = []
     for f in wave_files:
         f_name = os.path.basename(f)
         f_name = f_name[:-4]
-        filelist.append(f_name)
+        if not in_shard(f_name, shard_index, n_shards):
+            continue
 
         mel_save_path = os.path.join(args.mel_dir, f_name + '.mel')
-        res = p.apply_async(extract_melspectrum, (f, mel_save_path, hparams.sample_rate))
-        results.append(res)
+        stat = file_stat(f, fingerprint)
+        if manifest.get(f_name) == stat and os.path.exists(mel_save_path):
+            # unchanged since last extraction
+            shard_manifest[f_name] = stat
+            filelist.append(f_name)
+            continue
+        jobs.append((f_name, f, mel_save_path, stat))
 
-    p.close()
-    p.join()
-    for res in results:
-        output = res.get()
-        print(output)
+    print('{} files up to date, {} files to extract'.format(len(filelist), len(jobs)))
 
+    p = Pool(mp.cpu_count())
+    n_errors = 0
+    last_save_time = time.time()
+    try:
+        with codecs.open(args.error_log or os.path.join(args.mel_dir, 'errors.log'), 'a', 'utf-8') as error_log:
+            for i, (f_name, stat, error) in enumerate(p.imap_unordered(_extract_job, jobs, chunksize=4)):
+                if error is not None:
+                    n_errors += 1
+                    error_log.write('{}\n{}\n'.format(f_name, error))
+                    error_log.flush()
+                    print('failed to extract {}'.format(f_name))
+                    continue
+
+                shard_manifest[f_name] = stat
+                filelist.append(f_name)
+                print('[{}/{}] {}'.format(i + 1, len(jobs), f_name))
+
+                # save progress, so that an interrupted run resumes from here
+                if time.time() - last_save_time > 30:
+                    save_manifest(shard_manifest, manifest_path)
+                    last_save_time = time.time()
+    finally:
+        p.close()
+        p.join()
+        save_manifest(shard_manifest, manifest_path)
+
+    if n_errors > 0:
+        print('{} files failed, see the error log'.format(n_errors))
+
+    if n_shards > 1:
+        print('shard {}/{} done, run again without --shard to write the filelist'.format(shard_index, n_shards))
+        return
+
+    filelist.sort()
     gen_filelist(filelist, args.data_dir)
 
+    if args.shard_dir is not None:
+        pack_shards(filelist, args.wave_dir, args.mel_dir, args.shard_dir,
+                    args.shard_audio_dtype, args.shard_size_mb)
+
     print("job done!")
 
 
@@ -96,6 +255,15 @@ def get_arguments():
                         help='mel spectrum directory where to save the spectrum')
     parser.add_argument('--data_dir', type=str,
                         help='root folder of the data, where to save the filelist')
+    parser.add_argument('--shard', type=str, default=None,
+                        help='i/N, only extract the i-th of N parts of the corpus, so that machines can split it')
+    parser.add_argument('--error_log', type=str, default=None,
+                        help='where to log files failed to extract, default is mel_dir/errors.log')
+    parser.add_argument('--shard_dir', type=str, default=None,
+                        help='if specified, also pack audio and mel spectrum into memory-mappable shards')
+    parser.add_argument('--shard_audio_dtype', type=str, default='int16', choices=['int16', 'float16'])
+    parser.add_argument('--shard_size_mb', type=int, default=512,
+                        help='approximate audio size of one shard')
 
     args = parser.parse_args()
     return args
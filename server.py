@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import collections
+import io
+import json
+import queue
+import threading
+import time
+import numpy as np
+from scipy.io import wavfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from params import hparams
+from inference import load_model, pad_lc_batch, prepare_lc
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='WaveGlow synthesis server')
+    parser.add_argument('--restore_from', type=str, default=None,
+                        help='restore model from checkpoint')
+    parser.add_argument('--frozen_graph', type=str, default=None,
+                        help='load the graph written by export_graph.py instead of --restore_from')
+    parser.add_argument('--sigma', type=float, default=0.6,
+                        help='sigma value for inference')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max_batch_size', type=int, default=8,
+                        help='max number of requests merged into one batch')
+    parser.add_argument('--max_wait_ms', type=float, default=10.,
+                        help='how long the first request of a batch waits for others to arrive')
+    return parser.parse_args()
+
+
+class SynthesisRequest(object):
+    def __init__(self, lc):
+        self.lc = lc
+        self.arrival_time = time.time()
+        self.done = threading.Event()
+        self.waveform = None
+        self.error = None
+
+
+class BatchingSynthesizer(object):
+    '''Merges requests arriving within a wait window into one padded batch and synthesizes them by one run.'''
+
+    def __init__(self, sess, audio, lc_placeholder, lc_lengths_placeholder,
+                 max_batch_size=8, max_wait_ms=10., latency_window=1000):
+        self.sess = sess
+        self.audio = audio
+        self.lc_placeholder = lc_placeholder
+        self.lc_lengths_placeholder = lc_lengths_placeholder
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.queue = queue.Queue()
+
+        self.lock = threading.Lock()
+        self.batch_size_histogram = collections.Counter()
+        self.latencies = collections.deque(maxlen=latency_window)
+        self.n_requests = 0
+
+        self.thread = threading.Thread(target=self.thread_main, args=())
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def synthesize(self, lc):
+        '''synthesize T*80 lc, blocks until the batch it is merged into is done'''
+        request = SynthesisRequest(lc)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.waveform
+
+    def next_batch(self):
+        requests = [self.queue.get(block=True)]
+        deadline = requests[0].arrival_time + self.max_wait
+        while len(requests) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                requests.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return requests
+
+    def thread_main(self):
+        while True:
+            requests = self.next_batch()
+            try:
+                lc_batch = pad_lc_batch([r.lc for r in requests])
+                lc_lengths = np.array([len(r.lc) for r in requests], dtype=np.int32)
+                audio_output = self.sess.run(self.audio,
+                                             feed_dict={self.lc_placeholder: prepare_lc(lc_batch),
+                                                        self.lc_lengths_placeholder: lc_lengths})
+                for b, r in enumerate(requests):
+                    r.waveform = audio_output[b, :len(r.lc) * hparams.upsampling_rate, 0]
+            except Exception as e:
+                for r in requests:
+                    r.error = e
+
+            now = time.time()
+            with self.lock:
+                self.batch_size_histogram[len(requests)] += 1
+                self.n_requests += len(requests)
+                for r in requests:
+                    self.latencies.append(now - r.arrival_time)
+
+            for r in requests:
+                r.done.set()
+
+    def metrics(self):
+        with self.lock:
+            latencies = np.array(self.latencies)
+            metrics = {
+                'queue_depth': self.queue.qsize(),
+                'requests': self.n_requests,
+                'batch_size_histogram': {str(k): v for k, v in sorted(self.batch_size_histogram.items())},
+            }
+        if len(latencies) > 0:
+            metrics['latency_p50'] = float(np.percentile(latencies, 50))
+            metrics['latency_p99'] = float(np.percentile(latencies, 99))
+        return metrics
+
+
+def make_handler(synthesizer):
+    class SynthesisHandler(BaseHTTPRequestHandler):
+        '''
+        POST /synthesize with the raw float32 T*80 lc (same format as .mel files) as body, returns a 16bit wave
+        GET /metrics returns queue depth, batch size histogram and latency percentiles as json
+        '''
+
+        def send_body(self, code, content_type, body):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            self.send_body(200, 'application/json', json.dumps(synthesizer.metrics()).encode('utf-8'))
+
+        def do_POST(self):
+            if self.path != '/synthesize':
+                self.send_error(404)
+                return
+
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            lc = np.frombuffer(body, dtype=np.float32)
+            if lc.size == 0 or lc.size % hparams.num_mels != 0:
+                self.send_error(400, 'lc size is not a multiple of {}'.format(hparams.num_mels))
+                return
+            lc = lc.reshape((-1, hparams.num_mels))
+
+            try:
+                waveform = synthesizer.synthesize(lc)
+            except Exception as e:
+                self.send_error(500, str(e))
+                return
+
+            pcm = np.clip(waveform, -1., 1.) * 32767
+            buf = io.BytesIO()
+            wavfile.write(buf, hparams.sample_rate, pcm.astype(np.int16))
+            self.send_body(200, 'audio/wav', buf.getvalue())
+
+    return SynthesisHandler
+
+
+def main():
+    args = get_arguments()
+
+    sess, lc_placeholder, lc_lengths_placeholder, audio = load_model(args.restore_from, args.frozen_graph,
+                                                                     args.sigma)
+
+    synthesizer = BatchingSynthesizer(sess, audio, lc_placeholder, lc_lengths_placeholder,
+                                      args.max_batch_size, args.max_wait_ms)
+    synthesizer.start()
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(synthesizer))
+    print('serving on {}:{}'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print()
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,20 @@
 #! -*- encoding: utf-8 -*-
 from __future__ import print_function
-from data_reader import DataReader
+from data_reader import DataReader, ProcessDataReader
 from params import hparams
-import tensorflow as tf
 import time
 import argparse
+import json
 import os
+import threading
 import sys
 import numpy as np
 from scipy.io import wavfile
 from datetime import datetime
-from glow import WaveGlow, compute_waveglow_loss
-from tensorflow.python.client import timeline
 
 
+# tensorflow is imported in functions only: the spawned data processes of --input_pipeline=process
+# re-import this module as __mp_main__ and should not load tensorflow
 STARTED_DATESTRING = "{0:%Y-%m-%dT%H-%M-%S}".format(datetime.now())
 
 
@@ -28,10 +29,18 @@ def get_arguments():
     parser = argparse.ArgumentParser(description='Parallel WaveNet Network')
     parser.add_argument('--filelist', type=str, default=None, required=True,
                         help='filelist path for training data.')
-    parser.add_argument('--wave_dir', type=str, default=None, required=True,
+    parser.add_argument('--wave_dir', type=str, default=None,
                         help='wave data directory for training data.')
-    parser.add_argument('--lc_dir', type=str, default=None, required=True,
+    parser.add_argument('--lc_dir', type=str, default=None,
                         help='local condition directory for training data.')
+    parser.add_argument('--shard_dir', type=str, default=None,
+                        help='packed shards written by preprocess_data.py, instead of --wave_dir and --lc_dir')
+    parser.add_argument('--lc_cache_mb', type=int, default=1024,
+                        help='memory of the cache of lc features computed on the fly, when --lc_dir is not given')
+    parser.add_argument('--lc_cache_dir', type=str, default=None,
+                        help='directory caching lc features computed on the fly')
+    parser.add_argument('--lc_cache_dir_mb', type=int, default=10240,
+                        help='max size of --lc_cache_dir')
     parser.add_argument('--ngpu', type=int, default=1, help='gpu numbers')
     parser.add_argument('--run_name', type=str, default='waveglow',
                         help='run name for log saving')
@@ -39,6 +48,19 @@ def get_arguments():
                         help='restore model from checkpoint')
     parser.add_argument('--store_metadata', type=_str_to_bool, default=False,
                         help='Whether to store advanced debugging information')
+    parser.add_argument('--input_pipeline', type=str, default='tf_data', choices=['tf_data', 'queue', 'process'],
+                        help='tf.data pipeline, or python threads / worker processes feeding through feed_dict')
+    parser.add_argument('--data_workers', type=int, default=4,
+                        help='parallel file readers of the input pipeline')
+    parser.add_argument('--prefetch_to_device', type=_str_to_bool, default=False,
+                        help='Whether to stage input batches on the first gpu, tf_data pipeline only')
+    parser.add_argument('--summary_interval', type=int, default=100,
+                        help='steps between evaluating summaries and writing step metrics to TensorBoard')
+    parser.add_argument('--async_checkpoint', type=_str_to_bool, default=True,
+                        help='Whether to write checkpoints on a background thread')
+    parser.add_argument('--accumulate_steps', type=int, default=1,
+                        help='micro-batches whose gradients are accumulated before one update, '
+                             'the effective batch size is batch_size * ngpu * accumulate_steps')
     return parser.parse_args()
 
 
@@ -70,7 +92,59 @@ def save(saver, sess, logdir, step, write_meta_graph=False):
     print(' Done.')
 
 
+class AsyncSaver(object):
+    '''
+    snapshot variables to host memory in the training loop and write the checkpoint on a background thread.
+    the checkpoint is written from a shadow graph on cpu, whose variables are saved under the names of the
+    training variables, so that it is restored by the Saver of the training graph as usual
+    '''
+    def __init__(self, var_list, max_to_keep=30):
+        import tensorflow as tf
+        self.var_list = var_list
+        self.graph = tf.Graph()
+        with self.graph.as_default(), tf.device('/cpu:0'):
+            self.placeholders = [tf.placeholder(var.dtype.base_dtype, var.get_shape()) for var in var_list]
+            # initializing the shadow variables from the placeholders copies a snapshot in
+            shadow_vars = [tf.Variable(placeholder, trainable=False) for placeholder in self.placeholders]
+            self.load_ops = tf.group(*[var.initializer for var in shadow_vars])
+            self.saver = tf.train.Saver(var_list={var.op.name: shadow for var, shadow in zip(var_list, shadow_vars)},
+                                        max_to_keep=max_to_keep)
+        config = tf.ConfigProto(device_count={'GPU': 0})
+        self.sess = tf.Session(graph=self.graph, config=config)
+        self.thread = None
+        self.error = None
+
+    def save(self, sess, logdir, step):
+        # at most one checkpoint in flight, the host memory of snapshots is bounded
+        self.wait()
+        print('Snapshot checkpoint of step {} ...'.format(step))
+        values = sess.run(self.var_list)
+        self.thread = threading.Thread(target=self.write_main, args=(values, logdir, step))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write_main(self, values, logdir, step):
+        try:
+            self.sess.run(self.load_ops, feed_dict=dict(zip(self.placeholders, values)))
+            save(self.saver, self.sess, logdir, step)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        self.wait()
+        self.sess.close()
+
+
 def load(saver, sess, logdir):
+    import tensorflow as tf
     print("Trying to restore saved checkpoints from {} ...".format(logdir),
           end="")
 
@@ -102,6 +176,7 @@ def average_gradients(tower_grads):
         List of pairs of (gradient, variable) where the gradient has been averaged
             across all towers.
     """
+    import tensorflow as tf
     average_grads = []
     for grad_and_vars in zip(*tower_grads):
         # Note that each grad_and_vars looks like the following:
@@ -135,13 +210,51 @@ def average_gradients(tower_grads):
     return average_grads
 
 
+def accumulate_gradients(grads_and_vars, accumulate_steps, optimizer, global_step):
+    """
+    Sum gradients into non-trainable accumulators, then apply their mean once.
+    Args:
+        grads_and_vars: List of (gradient, variable) pairs, e.g. from average_gradients.
+        accumulate_steps: Number of micro-batches of one update.
+    Returns:
+        accumulate_ops adding the gradients of one micro-batch, and train_ops adding the gradients
+            of the last micro-batch, applying the mean and resetting the accumulators.
+            global_step is only incremented by train_ops, so it counts updates.
+    """
+    import tensorflow as tf
+    accumulators = []
+    accumulate_ops = []
+    for grad, var in grads_and_vars:
+        if grad is None:
+            continue
+        with tf.device('/cpu:0'):
+            accumulator = tf.Variable(tf.zeros(var.get_shape(), dtype=var.dtype.base_dtype), trainable=False,
+                                      name=var.op.name.replace('/', '_') + '_accumulator')
+        accumulators.append((accumulator, var))
+        accumulate_ops.append(accumulator.assign_add(grad))
+
+    with tf.control_dependencies(accumulate_ops):
+        mean_grads = [(accumulator.read_value() / accumulate_steps, var) for accumulator, var in accumulators]
+        apply_ops = optimizer.apply_gradients(mean_grads, global_step=global_step)
+    with tf.control_dependencies([apply_ops]):
+        train_ops = tf.group(*[accumulator.assign(tf.zeros_like(accumulator)) for accumulator, _ in accumulators])
+    return tf.group(*accumulate_ops), train_ops
+
+
 def main():
+    import tensorflow as tf
+    from tensorflow.python.client import timeline
+    from glow import WaveGlow, compute_waveglow_loss
+
     args = get_arguments()
     args.logdir = os.path.join(hparams.logdir_root, args.run_name)
     if not os.path.exists(args.logdir):
         os.makedirs(args.logdir)
 
     assert hparams.upsampling_rate == hparams.hop_length, 'upsamling rate should be same as hop_length'
+    assert args.shard_dir is not None or args.wave_dir is not None, \
+        'either --shard_dir or --wave_dir should be specified'
+    assert args.accumulate_steps >= 1, 'accumulate_steps should be at least 1'
 
     # Create coordinator.
     coord = tf.train.Coordinator()
@@ -151,13 +264,29 @@ def main():
 
     with tf.device('/cpu:0'):
         with tf.name_scope('inputs'):
-            reader = DataReader(coord, args.filelist, args.wave_dir, args.lc_dir)
+            reader_kwargs = {'shard_dir': args.shard_dir, 'lc_cache_mb': args.lc_cache_mb,
+                             'lc_cache_dir': args.lc_cache_dir, 'lc_cache_dir_mb': args.lc_cache_dir_mb}
+            if args.input_pipeline == 'process':
+                reader = ProcessDataReader(coord, args.filelist, args.wave_dir, args.lc_dir,
+                                           hparams.batch_size * args.ngpu, **reader_kwargs)
+            else:
+                reader = DataReader(coord, args.filelist, args.wave_dir, args.lc_dir, **reader_kwargs)
+            if args.input_pipeline == 'tf_data':
+                dataset = reader.create_dataset(hparams.batch_size * args.ngpu,
+                                                num_parallel_calls=args.data_workers,
+                                                device='/gpu:0' if args.prefetch_to_device else None)
+                iterator = dataset.make_initializable_iterator()
+                audio_placeholder, lc_placeholder = iterator.get_next()
 
     sess = tf.Session(config=tf.ConfigProto(log_device_placement=False, allow_soft_placement=True))
-    reader.start_threads()
+    if args.input_pipeline in ['queue', 'process']:
+        if args.input_pipeline == 'queue':
+            reader.start_threads(args.data_workers)
+        else:
+            reader.start_processes(args.data_workers)
 
-    audio_placeholder = tf.placeholder(tf.float32, shape=[None, None, 1], name='audio')
-    lc_placeholder = tf.placeholder(tf.float32, shape=[None, None, hparams.num_mels], name='lc')
+        audio_placeholder = tf.placeholder(tf.float32, shape=[None, None, 1], name='audio')
+        lc_placeholder = tf.placeholder(tf.float32, shape=[None, None, hparams.num_mels], name='lc')
 
     tower_losses = []
     tower_grads = []
@@ -196,7 +325,11 @@ def main():
     loss = tf.reduce_mean(tower_losses)
     averaged_gradients = average_gradients(tower_grads)
 
-    train_ops = optimizer.apply_gradients(averaged_gradients, global_step=global_step)
+    if args.accumulate_steps > 1:
+        accumulate_ops, train_ops = accumulate_gradients(averaged_gradients, args.accumulate_steps,
+                                                         optimizer, global_step)
+    else:
+        train_ops = optimizer.apply_gradients(averaged_gradients, global_step=global_step)
 
     tf.summary.scalar('loss', loss)
 
@@ -209,9 +342,20 @@ def main():
     # Set up session
     init = tf.global_variables_initializer()
     sess.run(init)
+    if args.input_pipeline == 'tf_data':
+        sess.run(iterator.initializer)
     print('parameters initialization finished')
 
     saver = tf.train.Saver(var_list=tf.trainable_variables(), max_to_keep=30)
+    async_saver = None
+    if args.async_checkpoint:
+        async_saver = AsyncSaver(tf.trainable_variables(), max_to_keep=30)
+
+    def save_checkpoint(step):
+        if async_saver is not None:
+            async_saver.save(sess, args.logdir, step)
+        else:
+            save(saver, sess, args.logdir, step)
 
     saved_global_step = 0
     if args.restore_from is not None:
@@ -227,53 +371,101 @@ def main():
                   "the previous model.")
             raise
 
+        # global_step is not in the checkpoint, restore it for the learning rate decay
+        global_step.load(saved_global_step, sess)
         print("restore model successfully!")
 
+    def next_feed_dict(metrics):
+        if args.input_pipeline == 'tf_data':
+            # batches are dequeued inside sess.run, their wait is part of the compute time
+            reader.pieces_consumed += hparams.batch_size * args.ngpu
+            return None
+        start_time = time.time()
+        wait_time = reader.wait_time
+        # lc is fed at frame rate, upsampling is done in the tf code
+        audio, lc = reader.dequeue(num_elements=hparams.batch_size * args.ngpu)
+        data_wait = reader.wait_time - wait_time
+        metrics['data_wait'] += data_wait
+        metrics['feed_prep'] += time.time() - start_time - data_wait
+        return {audio_placeholder: audio, lc_placeholder: lc}
+
+    # per step metrics, averaged over summary_interval steps for TensorBoard
+    metrics_file = open(os.path.join(args.logdir, 'step_metrics.jsonl'), 'a')
+    metric_names = ['data_wait', 'feed_prep', 'compute', 'summary_io', 'total', 'samples_per_sec', 'occupancy']
+    interval_metrics = []
+
     print('start training.')
     last_saved_step = saved_global_step
     try:
         for step in range(saved_global_step + 1, hparams.train_steps):
-            audio, lc = reader.dequeue(num_elements=hparams.batch_size * args.ngpu)
-
-            if hparams.lc_encode or hparams.transposed_upsampling:
-                # if using local condition bi-lstm encoding or tranposed conv upsampling, no need to upsample
-                # bi-lstm, upsamle will be done in the tf code
-                lc = np.reshape(lc, [hparams.batch_size * args.ngpu, -1, hparams.num_mels])
-            else:
-                # upsampling by directly repeat
-                lc = np.tile(lc, [1, 1, hparams.upsampling_rate])
-                lc = np.reshape(lc, [hparams.batch_size * args.ngpu, -1, hparams.num_mels])
-
             start_time = time.time()
-            if step % 50 == 0 and args.store_metadata:
+            metrics = {'data_wait': 0., 'feed_prep': 0., 'compute': 0., 'summary_io': 0.}
+            # every micro-batch but the last only accumulates gradients
+            micro_losses = []
+            for _ in range(args.accumulate_steps - 1):
+                micro_feed_dict = next_feed_dict(metrics)
+                compute_start_time = time.time()
+                micro_losses.append(sess.run([loss, accumulate_ops], feed_dict=micro_feed_dict)[0])
+                metrics['compute'] += time.time() - compute_start_time
+
+            feed_dict = next_feed_dict(metrics)
+            if feed_dict is not None and step == saved_global_step + 1:
+                print('feed {:d} bytes of audio and {:d} bytes of lc per step'
+                      .format(feed_dict[audio_placeholder].nbytes, feed_dict[lc_placeholder].nbytes))
+
+            store_metadata = step % 50 == 0 and args.store_metadata
+            write_summary = step % args.summary_interval == 0 or store_metadata
+            fetches = [loss, train_ops, learning_rate]
+            if write_summary:
+                fetches.append(summaries)
+
+            run_options = None
+            if store_metadata:
                 # Slow run that stores extra information for debugging.
                 print('Storing metadata')
                 run_options = tf.RunOptions(
                     trace_level=tf.RunOptions.FULL_TRACE)
-                summary, loss_value, _, lr = sess.run(
-                    [summaries, loss, train_ops, learning_rate],
-                    feed_dict={audio_placeholder: audio, lc_placeholder: lc},
-                    options=run_options,
-                    run_metadata=run_metadata)
-                writer.add_summary(summary, step)
+            compute_start_time = time.time()
+            results = sess.run(fetches, feed_dict=feed_dict, options=run_options,
+                               run_metadata=run_metadata if store_metadata else None)
+            metrics['compute'] += time.time() - compute_start_time
+            loss_value, _, lr = results[:3]
+
+            summary_start_time = time.time()
+            if write_summary:
+                writer.add_summary(results[3], step)
+            if store_metadata:
                 writer.add_run_metadata(run_metadata,
                                         'step_{:04d}'.format(step))
                 tl = timeline.Timeline(run_metadata.step_stats)
                 timeline_path = os.path.join(args.logdir, 'timeline.trace')
                 with open(timeline_path, 'w') as f:
                     f.write(tl.generate_chrome_trace_format(show_memory=True))
-            else:
-                summary, loss_value, _, lr = sess.run([summaries, loss, train_ops, learning_rate],
-                                                      feed_dict={audio_placeholder: audio, lc_placeholder: lc})
-                writer.add_summary(summary, step)
+            metrics['summary_io'] += time.time() - summary_start_time
 
+            loss_value = np.mean(micro_losses + [loss_value])
             duration = time.time() - start_time
-            step_log = 'step {:d} - loss = {:.3f}, lr={:.8f}, time cost={:4f}'\
-                .format(step, loss_value, lr, duration)
+            samples_per_sec = hparams.batch_size * args.ngpu * args.accumulate_steps / duration
+            metrics.update({'step': step, 'loss': float(loss_value), 'lr': float(lr), 'total': duration,
+                            'samples_per_sec': samples_per_sec, 'occupancy': reader.occupancy()})
+            metrics_file.write(json.dumps(metrics) + '\n')
+            interval_metrics.append(metrics)
+            if write_summary:
+                metrics_file.flush()
+                values = [tf.Summary.Value(tag='step_metrics/' + name,
+                                           simple_value=np.mean([m[name] for m in interval_metrics]))
+                          for name in metric_names]
+                writer.add_summary(tf.Summary(value=values), step)
+                interval_metrics = []
+
+            step_log = 'step {:d} - loss = {:.3f}, lr={:.8f}, time cost={:4f} (data {:.3f}, compute {:.3f}), ' \
+                       '{:.1f} samples/sec'.format(step, loss_value, lr, duration,
+                                                   metrics['data_wait'] + metrics['feed_prep'],
+                                                   metrics['compute'], samples_per_sec)
             print(step_log)
 
             if step % hparams.save_model_every == 0:
-                save(saver, sess, args.logdir, step)
+                save_checkpoint(step)
                 last_saved_step = step
 
     except KeyboardInterrupt:
@@ -282,7 +474,10 @@ def main():
         print()
     finally:
         if step > last_saved_step:
-            save(saver, sess, args.logdir, step)
+            save_checkpoint(step)
+        if async_saver is not None:
+            async_saver.close()
+        metrics_file.close()
         coord.request_stop()
         coord.join()
 